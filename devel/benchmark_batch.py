@@ -0,0 +1,76 @@
+"""
+Benchmark the batched likelihood, ``LikelihoodForeground2D.computeLikelihoodBatch``, against evaluating the same
+walkers one at a time.
+
+A stack of random "EoR" lightcones is passed through frozen foregrounds, the instrument and the 2D power spectrum,
+either as a single batch or walker by walker. Thermal noise is off, so both give the same likelihoods.
+
+Each walker is already processed in vectorised calls, so on a single core the batch saves little beyond Python
+overhead, and its larger working set can make it slower. Its larger FFTs and matrix products gain most from a
+multi-threaded FFT backend (and BLAS) on a larger node.
+
+Usage: python benchmark_batch.py [sky_cells] [fft_backend] [fft_threads]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from py21cmmc_fg.core import CoreForegrounds, CoreInstrumental
+from py21cmmc_fg.likelihood import LikelihoodForeground2D
+
+
+def bench(fnc, number=3):
+    fnc()
+    return min(timeit.repeat(fnc, number=1, repeat=number))
+
+
+if __name__ == "__main__":
+    sky_cells = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    fft_backend = sys.argv[2] if len(sys.argv) > 2 else "numpy"
+    fft_threads = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    np.random.seed(1)
+
+    redshifts = np.linspace(7.5, 8.5, 64)
+    boxsize = 300.0
+
+    fg = CoreForegrounds(
+        pt_source_params=dict(S_min=1e-1, S_max=1.0), diffuse_params={}, redshifts=redshifts, boxsize=boxsize,
+        sky_cells=sky_cells, freeze_foregrounds=True
+    )
+    instrument = CoreInstrumental(
+        "mwa_phase2", 150, 160, 32, max_bl_length=150.0, fft_backend=fft_backend, fft_threads=fft_threads
+    )
+    instrument.setup()
+
+    likelihood = LikelihoodForeground2D(None, n_psbins=20, fft_backend=fft_backend, fft_threads=fft_threads)
+
+    # Fake data, so that the likelihood can be evaluated.
+    p, k = likelihood.power_spectrum(
+        instrument.instrument_response(
+            np.zeros((sky_cells, sky_cells, len(redshifts))), 1420e6 / (1 + redshifts),
+            fg.get_sky_size(boxsize, redshifts)
+        ), instrument.baselines, instrument.instrumental_frequencies, sky_cells
+    )
+    likelihood.power = np.ones_like(p)
+    likelihood.uncertainty = np.ones_like(p)
+    likelihood._checked = True
+
+    for nwalkers in (1, 4, 16):
+        lightcones = np.random.normal(size=(nwalkers, sky_cells, sky_cells, len(redshifts)))
+
+        def batch():
+            return likelihood.computeLikelihoodBatch(lightcones.copy(), redshifts, boxsize, fg, instrument)
+
+        def serial():
+            return np.array([
+                likelihood.computeLikelihoodBatch(lc[None].copy(), redshifts, boxsize, fg, instrument)[0]
+                for lc in lightcones
+            ])
+
+        assert np.allclose(batch(), serial(), rtol=1e-6)
+        t_batch, t_serial = bench(batch), bench(serial)
+
+        print(
+            "nwalkers=%2d: serial %.3f s, batch %.3f s (%.2fx)" % (nwalkers, t_serial, t_batch, t_serial / t_batch)
+        )
@@ -0,0 +1,61 @@
+"""
+Benchmark the per-evaluation overhead of the cosmological/unit conversions in the power spectrum hot path.
+
+Compares evaluating the factors needed by ``LikelihoodForeground2D.get_2d_power`` directly with astropy (as was
+done on every call previously) against the memoized plain-float versions in :mod:`py21cmmc_fg.conversions`.
+"""
+import timeit
+
+import numpy as np
+from astropy import constants as const
+from astropy import units as un
+from astropy.cosmology import Planck15 as cosmo
+
+from py21cmmc_fg import conversions
+
+nu_min, nu_max = 150e6, 160e6
+z_mid = 1420e6 / ((nu_min + nu_max) / 2) - 1
+ugrid = np.linspace(-100, 100, 100)
+eta = np.linspace(0, 1e-5, 17)
+
+
+def with_astropy():
+    kperp = 2 * np.pi * ugrid / cosmo.comoving_transverse_distance([z_mid])
+    kpar = 2 * np.pi * eta * cosmo.H0.to(un.m / (un.Mpc * un.s)) * 1420e6 * un.Hz * cosmo.efunc(z_mid) / (
+            const.c * (1 + z_mid) ** 2)
+
+    A_eff = 20 * un.m ** 2
+    k_to_jy = (2 * 1e26 * const.k_B * 1e-3 * un.K / (A_eff * (1 * un.Hz) * (1 * un.s))).to(
+        un.W / (un.Hz * un.m ** 2))
+
+    z_max, z_min = 1420e6 / nu_min - 1, 1420e6 / nu_max - 1
+    hz_to_mpc = (cosmo.comoving_distance(z_max) - cosmo.comoving_distance(z_min)) / (nu_max - nu_min)
+    sr_to_mpc2 = cosmo.comoving_distance(z_mid) / (1 * un.sr)
+
+    G_z = cosmo.H0.to(un.m / (un.Mpc * un.s)) * 1420e6 * un.Hz * cosmo.efunc(z_mid) / (const.c * (1 + z_mid) ** 2)
+    vol = const.c ** 2 / (A_eff * nu_max * (1 / un.s) ** 2) * (nu_max - nu_min) * (
+            1 / un.s) * cosmo.comoving_distance([z_mid]) ** 2 / G_z
+
+    return kperp.value, kpar.value, ((k_to_jy * hz_to_mpc * sr_to_mpc2) ** 2).value, vol.value
+
+
+def with_cache():
+    kperp = 2 * np.pi * ugrid / conversions.comoving_transverse_distance(z_mid)
+    kpar = eta * conversions.eta_to_kpar(z_mid)
+    factor = (conversions.K_to_Jy() * conversions.hz_to_mpc(nu_min, nu_max) * conversions.sr_to_mpc2(z_mid)) ** 2
+    vol = conversions.volume(z_mid, nu_min, nu_max)
+
+    return kperp, kpar, factor, vol
+
+
+if __name__ == "__main__":
+    for a, b in zip(with_astropy(), with_cache()):
+        assert np.allclose(a, b, rtol=1e-12), (a, b)
+
+    n = 200
+    t_astropy = timeit.timeit(with_astropy, number=n) / n
+    t_cache = timeit.timeit(with_cache, number=n) / n
+
+    print("astropy:  %.3g ms per evaluation" % (1e3 * t_astropy))
+    print("memoized: %.3g ms per evaluation" % (1e3 * t_cache))
+    print("speedup:  %.0fx" % (t_astropy / t_cache))
@@ -0,0 +1,55 @@
+"""
+Benchmark the FFT backends of :mod:`py21cmmc_fg.dft` for the two transforms done at every MCMC step:
+
+* the spatial (image to uv) transform of the beam-weighted lightcone, in ``CoreInstrumental.image_to_uv``;
+* the frequency transform of the gridded visibilities, in ``LikelihoodForeground2D.frequency_fft``.
+
+Sizes are representative of an MWA-like (small box, compact array) and SKA-like (large box) configuration.
+
+Usage: python benchmark_fft.py [nthreads]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from py21cmmc_fg import dft
+from py21cmmc_fg.core import CoreInstrumental
+from py21cmmc_fg.likelihood import LikelihoodForeground2D
+
+SIZES = {
+    # name: (sky cells, lightcone slices, uv cells, instrumental frequencies)
+    "MWA": (128, 64, 128, 64),
+    "SKA": (512, 64, 512, 128),
+}
+
+
+def bench(fnc, number=3):
+    fnc()  # warm-up (and planning, for pyfftw)
+    return min(timeit.repeat(fnc, number=1, repeat=number))
+
+
+if __name__ == "__main__":
+    nthreads = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    backends = ["numpy", "scipy"] + (["pyfftw"] if dft.pyfftw is not None else [])
+    freqs = {}
+
+    for size, (ncells, nslices, n_uv, nfreq) in SIZES.items():
+        sky = np.random.normal(size=(ncells, ncells, nslices))
+        vis = np.random.normal(size=(n_uv, n_uv, nfreq)) + 1j * np.random.normal(size=(n_uv, n_uv, nfreq))
+        freq = np.linspace(150e6, 160e6, nfreq)
+
+        print("%s: sky %s, gridded visibilities %s" % (size, sky.shape, vis.shape))
+        for name in backends:
+            backend = dft.get_backend(name, nthreads)
+
+            t_full = bench(lambda: CoreInstrumental.image_to_uv(sky, 0.3, hermitian=False, backend=backend))
+            t_half = bench(lambda: CoreInstrumental.image_to_uv(sky, 0.3, backend=backend))
+            t_freq = bench(lambda: LikelihoodForeground2D.frequency_fft(vis, freq, backend=backend))
+
+            print(
+                "  %-7s (%2d threads): image_to_uv full %7.1f ms, half %7.1f ms; frequency_fft %7.1f ms" % (
+                    name, backend.nthreads, 1e3 * t_full, 1e3 * t_half, 1e3 * t_freq
+                )
+            )
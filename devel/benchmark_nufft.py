@@ -0,0 +1,74 @@
+"""
+Benchmark the two ways ``CoreInstrumental`` can evaluate visibilities at the baselines:
+
+* "grid": FFT the sky onto a regular UV grid and bilinearly interpolate onto the baselines (optionally after
+  zero-padding the sky, which refines the UV grid and so reduces the interpolation error);
+* "nufft": evaluate the transform directly at each baseline with a non-uniform FFT, at several accuracies.
+
+The error of each is the relative rms difference from a very accurate (eps=1e-12) NUFFT, which agrees with a direct
+DFT to ~1e-12. Two arrays are used: the compact MWA Phase II core, and a sparse array of a few long baselines (for
+which the visibilities are few, but sample the UV plane out to its edge).
+
+Usage: python benchmark_nufft.py [nfreq]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from py21cmmc_fg.core import CoreForegrounds, CoreInstrumental
+
+CONFIGS = {
+    # name: (sky cells, sky size in radians, baselines in metres)
+    "MWA compact": (128, 0.3, None),
+    "sparse, long": (256, 0.2, 1100.0),
+}
+
+
+def bench(fnc, number=3):
+    fnc()
+    return min(timeit.repeat(fnc, number=1, repeat=number))
+
+
+def grid_sampling(sky, L, baselines, frequencies, pad=1):
+    if pad > 1:
+        n = sky.shape[0]
+        sky = np.pad(sky, ((0, (pad - 1) * n), (0, (pad - 1) * n), (0, 0)))
+    uvplane, uv = CoreInstrumental.image_to_uv(sky, L * pad)
+    return CoreInstrumental.sample_onto_baselines(uvplane, uv, baselines, frequencies)
+
+
+def relative_rms(a, b):
+    return np.sqrt(np.mean(np.abs(a - b) ** 2) / np.mean(np.abs(b) ** 2))
+
+
+if __name__ == "__main__":
+    nfreq = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    np.random.seed(1)
+    frequencies = np.linspace(150e6, 160e6, nfreq)
+
+    for name, (ncells, L, extent) in CONFIGS.items():
+        if extent is None:
+            instrument = CoreInstrumental("mwa_phase2", 150, 160, nfreq, max_bl_length=150.0)
+            instrument.setup()
+            baselines = instrument.baselines.value
+        else:
+            ant = np.random.uniform(-extent / 2, extent / 2, size=(32, 2))
+            baselines = CoreInstrumental.get_baselines(ant[:, 0], ant[:, 1])
+
+        sky = np.asarray(CoreForegrounds.point_sources(frequencies, ncells, L, S_min=1e-2)) + \
+              np.asarray(CoreForegrounds.diffuse(frequencies, ncells, L)) * CoreForegrounds.conversion_factor_K_to_Jy()
+        sky *= CoreInstrumental.beam(frequencies, ncells, L, 4.0)
+
+        exact = CoreInstrumental.sample_nufft(sky, L, baselines, frequencies, eps=1e-12)
+
+        print("%s: sky %s, %d baselines" % (name, sky.shape, len(baselines)))
+        for pad in (1, 2, 4):
+            t = bench(lambda: grid_sampling(sky, L, baselines, frequencies, pad))
+            err = relative_rms(grid_sampling(sky, L, baselines, frequencies, pad), exact)
+            print("  grid  (padding %dx) %8.1f ms, error %.1e" % (pad, 1e3 * t, err))
+
+        for eps in (1e-2, 1e-4, 1e-6):
+            t = bench(lambda: CoreInstrumental.sample_nufft(sky, L, baselines, frequencies, eps=eps))
+            err = relative_rms(CoreInstrumental.sample_nufft(sky, L, baselines, frequencies, eps=eps), exact)
+            print("  nufft (eps=%.0e)  %8.1f ms, error %.1e" % (eps, 1e3 * t, err))
@@ -0,0 +1,72 @@
+"""
+Check that the gridded faint-source model of ``CoreForegrounds.point_sources`` (``S_faint``) reproduces the flux
+statistics of drawing every source explicitly, and compare their cost.
+
+For each model, many realisations are drawn, and the mean and variance of the total flux per cell (over all cells and
+realisations) and of the total flux on the sky are compared to those of the explicit draw, and to the analytic
+compound-Poisson values.
+
+Usage: python check_faint_sources.py [nrealisations]
+"""
+import sys
+import timeit
+
+import numpy as np
+from scipy.integrate import quad
+
+from py21cmmc_fg.core import CoreForegrounds
+
+NCELLS = 64
+PARAMS = dict(S_min=1e-3, S_max=1.0, alpha=4100., beta=1.59)
+S_FAINT = 5e-2
+
+# Give the cells unit area, so that the sky is in Jy per cell.
+frequencies = np.array([150e6])
+sky_size = NCELLS
+
+
+def draw(**kwargs):
+    return np.asarray(CoreForegrounds.point_sources(frequencies, NCELLS, sky_size, **PARAMS, **kwargs))[:, :, 0]
+
+
+def statistics(maps):
+    # Exclude edge cells, which have a different expected number of sources.
+    inner = maps[:, 1:-1, 1:-1]
+    return inner.mean(), inner.var(), maps.sum(axis=(1, 2)).mean(), maps.sum(axis=(1, 2)).var()
+
+
+if __name__ == "__main__":
+    nreal = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    np.random.seed(42)
+
+    # Analytic values for an interior cell, and for the whole sky.
+    source_count = lambda x: PARAMS['alpha'] * x ** (-PARAMS['beta'])
+    s1 = quad(lambda x: x * source_count(x), PARAMS['S_min'], PARAMS['S_max'])[0]
+    s2 = quad(lambda x: x ** 2 * source_count(x), PARAMS['S_min'], PARAMS['S_max'])[0]
+    frac = 1. / (NCELLS - 1) ** 2
+    expected = (frac * s1, frac * s2, s1, s2)
+
+    models = {
+        "explicit": dict(),
+        "gaussian": dict(S_faint=S_FAINT, faint_method="gaussian"),
+        "poisson": dict(S_faint=S_FAINT, faint_method="poisson"),
+    }
+
+    print("%-9s %12s %12s %12s %12s %10s" % ("model", "cell mean", "cell var", "total mean", "total var", "time [ms]"))
+    print("%-9s %12.4g %12.4g %12.4g %12.4g" % (("analytic",) + expected))
+
+    results = {}
+    for name, kwargs in models.items():
+        maps = np.array([draw(**kwargs) for _ in range(nreal)])
+        results[name] = statistics(maps)
+        t = min(timeit.repeat(lambda: draw(**kwargs), number=1, repeat=5))
+        print("%-9s %12.4g %12.4g %12.4g %12.4g %10.2f" % ((name,) + results[name] + (1e3 * t,)))
+
+    # The variance of the total flux is only estimated from nreal samples.
+    rtol = (0.05, 0.05, 0.05, 3 * np.sqrt(2. / nreal))
+    for name in ("gaussian", "poisson"):
+        for stat, a, b, tol in zip(
+                ("cell mean", "cell var", "total mean", "total var"), results[name], results["explicit"], rtol):
+            assert np.isclose(a, b, rtol=tol), "%s: %s differs from the explicit draw (%s vs %s)" % (name, stat, a, b)
+
+    print("Faint-source statistics match the explicit draw.")
@@ -0,0 +1,67 @@
+"""
+Compare the accuracy and cost of early frequency decimation (``CoreForegrounds(frequencies=...)``) against the default
+order of operations, in which every lightcone slice is passed through the instrument and the visibilities are only
+interpolated onto the instrumental frequencies at the end.
+
+Decimation interpolates the *sky* in frequency before the (frequency-dependent) beam and baseline sampling, rather
+than the visibilities after them. The two agree exactly for a sky that is linear in frequency, and differ by the
+curvature of the sky (and of the beam/uv-sampling) over the spacing of the lightcone slices. The noiseless
+visibilities of the EoR signal and of the foregrounds are compared separately below.
+
+Usage: python check_frequency_decimation.py [nslices]
+"""
+import sys
+import time
+
+import numpy as np
+
+from py21cmmc_fg.core import CoreForegrounds, CoreInstrumental
+
+NCELLS = 64
+BOXSIZE = 300.0
+FREQ_MIN, FREQ_MAX, NFREQ = 150, 160, 35
+
+
+def relative_rms(a, b):
+    return np.sqrt(np.mean(np.abs(a - b) ** 2) / np.mean(np.abs(b) ** 2))
+
+
+if __name__ == "__main__":
+    nslices = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    np.random.seed(1)
+
+    redshifts = np.linspace(7.8, 8.5, nslices)
+    freq_lc = 1420e6 / (1 + redshifts)
+
+    fg_core = CoreForegrounds(redshifts=redshifts, boxsize=BOXSIZE, sky_cells=NCELLS)
+    instrument = CoreInstrumental("mwa_phase2", FREQ_MIN, FREQ_MAX, NFREQ)
+    instrument.setup()
+    freq_inst = instrument.instrumental_frequencies
+
+    eor = np.random.normal(scale=10.0, size=(NCELLS, NCELLS, nslices)) * fg_core.conversion_factor_K_to_Jy()
+
+    fg_full, _, sky_size = fg_core.add_foregrounds(NCELLS, redshifts, BOXSIZE, rng=np.random.default_rng(2))
+    fg_dec, _, _ = fg_core.add_foregrounds(
+        NCELLS, redshifts, BOXSIZE, frequencies=freq_inst, rng=np.random.default_rng(2)
+    )
+
+    skies = {
+        "EoR": (eor, CoreForegrounds.resample_lightcone(eor, freq_lc, freq_inst)),
+        "foregrounds": (fg_full, fg_dec),
+    }
+
+    print("%d lightcone slices -> %d instrumental channels" % (nslices, NFREQ))
+    for name, (full, dec) in skies.items():
+        t = time.time()
+        vis_full = instrument.instrument_response(full, freq_lc, sky_size)
+        t_full = time.time() - t
+
+        t = time.time()
+        vis_dec = instrument.instrument_response(dec, freq_inst, sky_size)
+        t_dec = time.time() - t
+
+        print(
+            "  %-11s relative rms difference %.2e; time %.2f s (all slices) vs %.2f s (decimated)" % (
+                name, relative_rms(vis_dec, vis_full), t_full, t_dec
+            )
+        )
@@ -0,0 +1,65 @@
+"""
+Check that ``LikelihoodForeground2D.grid`` (a single ``np.bincount`` over cached cell indices) gives the same grid as
+the original gridder, which binned the visibilities of each frequency with ``np.histogram2d``.
+
+In particular, the longest baseline at the highest frequency lies exactly on the edge of the (default) grid, and
+must be kept in the last cell rather than dropped by rounding.
+
+Usage: python check_gridding.py
+"""
+import numpy as np
+from astropy import constants as const
+
+from py21cmmc_fg.core import CoreInstrumental
+from py21cmmc_fg.likelihood import LikelihoodForeground2D
+
+NGRID = 30
+FREQ_MIN, FREQ_MAX, NFREQ = 150, 160, 16
+
+
+def histogram_grid(visibilities, baselines, frequencies, ngrid, umax=None):
+    # The original gridder, one frequency at a time.
+    if umax is None:
+        umax = np.abs(baselines).max() * frequencies.max() / const.c.value
+
+    ugrid = np.linspace(-umax, umax, ngrid + 1)
+    visgrid = np.zeros((ngrid, ngrid, len(frequencies)), dtype=np.complex128)
+    weights = np.zeros((ngrid, ngrid, len(frequencies)))
+
+    for j, f in enumerate(frequencies):
+        u = baselines[:, 0] * f / const.c.value
+        v = baselines[:, 1] * f / const.c.value
+
+        weights[:, :, j] = np.histogram2d(u, v, bins=[ugrid, ugrid])[0]
+        rl = np.histogram2d(u, v, bins=[ugrid, ugrid], weights=np.real(visibilities[:, j]))[0]
+        im = np.histogram2d(u, v, bins=[ugrid, ugrid], weights=np.imag(visibilities[:, j]))[0]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            visgrid[:, :, j] = (rl + im * 1j) / weights[:, :, j]
+
+    visgrid[np.isnan(visgrid)] = 0.0
+    return (ugrid[1:] + ugrid[:-1]) / 2, visgrid, weights
+
+
+if __name__ == "__main__":
+    instrument = CoreInstrumental("mwa_phase2", FREQ_MIN, FREQ_MAX, NFREQ, max_bl_length=150.0)
+    instrument.setup()
+
+    baselines = instrument.baselines.value
+    frequencies = instrument.instrumental_frequencies
+
+    rng = np.random.default_rng(0)
+    visibilities = rng.normal(size=(len(baselines), NFREQ)) + 1j * rng.normal(size=(len(baselines), NFREQ))
+
+    for umax in (None, 50.0):
+        centres, visgrid, weights = LikelihoodForeground2D.grid(visibilities, baselines, frequencies, NGRID, umax)
+        ref_centres, ref_visgrid, ref_weights = histogram_grid(visibilities, baselines, frequencies, NGRID, umax)
+
+        print(
+            "umax=%s: centres %s, weights %s (total %d), max |visgrid difference| %.2e" % (
+                umax, np.allclose(centres, ref_centres), np.array_equal(weights, ref_weights), weights.sum(),
+                np.abs(visgrid - ref_visgrid).max()
+            )
+        )
+        assert np.array_equal(weights, ref_weights)
+        assert np.allclose(visgrid, ref_visgrid, rtol=1e-12, atol=1e-12)
@@ -0,0 +1,209 @@
+"""
+A persistent, content-addressed cache of arrays on disk.
+
+Reruns and restarts of chains (and of :meth:`~likelihood.LikelihoodForeground2D.simulate_data`) generate many of the
+same arrays again, such as foreground lightcones and their UV-plane transforms. A :class:`DiskCache` stores them in
+a directory, under a hash of everything they were generated from, as ``.npy`` files which are memory-mapped (and so
+only read as they are used) when loaded. The total size of the cache is capped, by evicting the least recently used
+entries.
+
+The cache is opt-in: see the `disk_cache` options of :class:`~core.CoreForegrounds` and
+:class:`~core.CoreInstrumental`. The same directory may be shared by several processes.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+#: Version of the cached data. Bump it when the way cached arrays are generated changes, to invalidate old entries.
+VERSION = 1
+
+
+def _update(h, obj):
+    # Feed a canonical encoding of obj to the hash h.
+    if isinstance(obj, np.ndarray):
+        h.update(("ndarray%s%s%s" % (obj.dtype.str, obj.shape, getattr(obj, "unit", ""))).encode())
+        h.update(memoryview(np.ascontiguousarray(obj)).cast("B"))
+    elif isinstance(obj, dict):
+        h.update(b"dict%d" % len(obj))
+        for key in sorted(obj, key=str):
+            _update(h, key)
+            _update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"list%d" % len(obj))
+        for o in obj:
+            _update(h, o)
+    else:
+        h.update(("%s:%r" % (type(obj).__name__, obj)).encode())
+
+
+def user_directory():
+    """
+    The package's directory in the user's cache: ``$XDG_CACHE_HOME/py21cmmc_fg`` (by default,
+    ``~/.cache/py21cmmc_fg``). It is not created.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "py21cmmc_fg")
+
+
+def digest(*parts):
+    """
+    A hex hash of any combination of arrays, scalars, strings, and (nested) lists, tuples and dicts of them.
+
+    Equal values (arrays of the same dtype, shape and contents) give the same hash, in any process.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    _update(h, (VERSION,) + parts)
+    return h.hexdigest()
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes=2**32):
+        """
+        A directory of cached arrays, keyed by a hash of whatever they were generated from.
+
+        Each entry is a sub-directory holding one or more named arrays (as ``.npy`` files) and a small JSON
+        dictionary of metadata. Entries are written atomically, so that processes sharing the directory only ever
+        see complete entries.
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the cache. It is created if it doesn't exist.
+
+        max_bytes : int, optional
+            The maximum total size of the cached arrays. When it is exceeded, the least recently used entries are
+            deleted.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts):
+        """
+        The key of an entry generated from `parts` (see :func:`digest`).
+        """
+        return digest(*parts)
+
+    def get(self, key):
+        """
+        Load an entry, lazily.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry.
+
+        Returns
+        -------
+        arrays : dict or None
+            The read-only, memory-mapped arrays of the entry, by name, or None if there is no such entry.
+
+        meta : dict or None
+            The metadata of the entry.
+        """
+        path = os.path.join(self.directory, key)
+
+        try:
+            with open(os.path.join(path, "meta.json")) as fl:
+                meta = json.load(fl)
+            arrays = {
+                name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in meta.pop("_arrays")
+            }
+
+            # Mark the entry as recently used.
+            os.utime(path)
+        except (FileNotFoundError, NotADirectoryError):
+            # No such entry, or it was evicted while being read.
+            self.misses += 1
+            return None, None
+
+        self.hits += 1
+        return arrays, meta
+
+    def put(self, key, arrays, **meta):
+        """
+        Store an entry, and evict old entries if the cache is then too large.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry.
+
+        arrays : dict
+            The arrays of the entry, by name.
+
+        meta :
+            Any JSON-serialisable metadata to store with the entry.
+        """
+        path = os.path.join(self.directory, key)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + ".npy"), np.asarray(array))
+            with open(os.path.join(tmp, "meta.json"), "w") as fl:
+                json.dump(dict(meta, _arrays=list(arrays)), fl)
+
+            os.rename(tmp, path)
+        except OSError:
+            # Either the entry has been written (eg. by another process) in the meantime, or it can't be written.
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+
+    def entries(self):
+        """
+        The ``(key, size in bytes, last use)`` of each entry, least recently used first.
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith(".tmp-"):
+                continue
+
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(path))
+                entries.append((key, size, os.stat(path).st_mtime))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+        return sorted(entries, key=lambda e: e[2])
+
+    @property
+    def nbytes(self):
+        """The total size of the cache, in bytes."""
+        return sum(e[1] for e in self.entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Delete the least recently used entries until the cache is no larger than `max_bytes` (by default, the
+        cache's `max_bytes`). Arrays already loaded from them remain valid.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for key, size, _ in entries:
+            if total <= max_bytes:
+                break
+
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """
+        Delete all entries.
+        """
+        self.evict(0)
+
+    def __len__(self):
+        return len(self.entries())
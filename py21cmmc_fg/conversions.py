@@ -0,0 +1,123 @@
+"""
+Cosmological and unit conversion factors used throughout the cores and likelihoods.
+
+Each factor depends only on the frequency band and/or redshift of the observation, which are fixed for an entire
+chain. They are therefore evaluated once (with astropy) and memoized as plain floats, so that the per-iteration
+code does not have to do any astropy Quantity arithmetic.
+"""
+from functools import lru_cache
+
+import numpy as np
+from astropy import constants as const
+from astropy import units as un
+from astropy.cosmology import Planck15 as cosmo  # TODO: this is not quite correct, if we pass cosmo parameters.
+
+#: Maximum number of distinct redshifts/bands for which each factor is memoized.
+CACHE_SIZE = 128
+
+#: Rest-frame frequency of the 21cm line, in Hz.
+F21 = 1420e6
+
+#: Speed of light, in m/s.
+C = const.c.to(un.m / un.s).value
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _comoving_distance(z):
+    return cosmo.comoving_distance(z).to(un.Mpc).value
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _comoving_transverse_distance(z):
+    return cosmo.comoving_transverse_distance(z).to(un.Mpc).value
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _efunc(z):
+    return float(cosmo.efunc(z))
+
+
+def comoving_distance(z):
+    """
+    The line-of-sight comoving distance to redshift `z`, in Mpc.
+    """
+    return _comoving_distance(float(z))
+
+
+def comoving_transverse_distance(z):
+    """
+    The transverse comoving distance to redshift `z`, in Mpc.
+    """
+    return _comoving_transverse_distance(float(z))
+
+
+def efunc(z):
+    """
+    The dimensionless Hubble parameter, E(z) = H(z)/H0.
+    """
+    return _efunc(float(z))
+
+
+@lru_cache(maxsize=1)
+def _hubble_constant():
+    return cosmo.H0.to(un.m / (un.Mpc * un.s)).value
+
+
+def eta_to_kpar(z):
+    """
+    The factor which converts eta (in 1/Hz, i.e. the Fourier dual of frequency) to kpar (in 1/Mpc) at redshift `z`.
+    """
+    return 2 * np.pi * _hubble_constant() * F21 * efunc(z) / (C * (1 + z) ** 2)
+
+
+@lru_cache(maxsize=1)
+def K_to_Jy():
+    """
+    The (frequency-independent) factor converting temperature in mK to flux density in Jy.
+
+    Assumes an effective area of 20 m^2. See :meth:`~core.CoreForegrounds.conversion_factor_K_to_Jy`.
+    """
+    # TODO: unfortunately, this is instrument-dependent and so should really go in the instrumental core
+    A_eff = 20 * un.m ** 2
+
+    flux_density = (2 * 1e26 * const.k_B * 1e-3 * un.K / (A_eff * (1 * un.Hz) * (1 * un.s))).to(
+        un.W / (un.Hz * un.m ** 2))
+
+    return flux_density.value
+
+
+def hz_to_mpc(nu_min, nu_max):
+    """
+    Convert a frequency range in Hz to a distance range in Mpc.
+    """
+    z_max = F21 / nu_min - 1
+    z_min = F21 / nu_max - 1
+
+    return (comoving_distance(z_max) - comoving_distance(z_min)) / (nu_max - nu_min)
+
+
+def sr_to_mpc2(z):
+    """
+    Conversion factor from steradian to Mpc^2 at a given redshift.
+    """
+    return comoving_distance(z)
+
+
+def volume(z_mid, nu_min, nu_max, A_eff=20):
+    """
+    Calculate the effective volume of an observation in Mpc**3, when co-ordinates are provided in Hz.
+
+    See :meth:`~likelihood.LikelihoodForeground2D.volume`.
+    """
+    diff_nu = nu_max - nu_min
+
+    G_z = _hubble_constant() * F21 * efunc(z_mid) / (C * (1 + z_mid) ** 2)
+
+    return C ** 2 / (A_eff * nu_max) * diff_nu * comoving_distance(z_mid) ** 2 / G_z
+
+
+def sky_size(boxsize, z):
+    """
+    The angular size (in radians) subtended by a transverse comoving length `boxsize` (in Mpc) at redshift `z`.
+    """
+    return 2 * np.arctan(boxsize / (2 * comoving_transverse_distance(z)))
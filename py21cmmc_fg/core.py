@@ -8,23 +8,233 @@ Created on Tue Apr 17 14:13:39 2018
 Foreground core for 21cmmc
 
 """
+import logging
+import os
+import queue
+import tempfile
+import threading
+import weakref
+from functools import lru_cache, partial
 from scipy.integrate import quad
 import numpy as np
 from astropy import constants as const
-from astropy.cosmology import Planck15 as cosmo  # TODO: this is not quite correct, if we pass cosmo parameters.
 from astropy import units as un
-from scipy.interpolate import RegularGridInterpolator
-from powerbox.dft import fft
+from scipy.sparse import csr_matrix
 from powerbox import LogNormalPowerBox
 from os import path
 from py21cmmc import LightCone
 
+from . import cache, conversions, dft, nufft, shared, sky, stages
+
+logger = logging.getLogger(__name__)
+
+
+def _in_metres(length):
+    """
+    Return a length (or array of lengths, eg. baselines) as a plain float (array) in metres, whether or not it
+    carries astropy units.
+    """
+    if hasattr(length, "unit"):
+        return length.to(un.m).value
+    return np.asarray(length, dtype=float)
+
+
+def _seed_sequence(seed, name):
+    """
+    The :class:`numpy.random.SeedSequence` of a core, from an int, a SeedSequence or None (fresh entropy). Its
+    entropy is logged (at INFO level), so that the random streams of a run can be replayed.
+    """
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    logger.info("Random seed of %s: %d", name, seed.entropy)
+    return seed
+
+
+#: Maximum number of distinct diffuse density fields (parameters and grid) kept in memory.
+DIFFUSE_CACHE_SIZE = 16
+
+
+@lru_cache(maxsize=DIFFUSE_CACHE_SIZE)
+def _diffuse_density(ncells, sky_size, u0, eta, rho, seed):
+    """
+    The (fixed-seed, and so deterministic) lognormal density field of the diffuse foregrounds. Read-only.
+
+    See :meth:`CoreForegrounds.diffuse`.
+    """
+    power_spectrum = lambda u: eta ** 2 * (u / u0) ** rho
+
+    # Create a log normal distribution of fluctuations
+    pb = LogNormalPowerBox(N=ncells, pk=power_spectrum, dim=2, boxlength=sky_size, a=0, b=2 * np.pi, seed=seed)
+
+    density = pb.delta_x() + 1
+    if not np.std(density) > 0:
+        density = np.ones((ncells, ncells))
+
+    density.flags.writeable = False
+    return density
+
+
+@lru_cache(maxsize=4)
+def _beam_lm2(ncells, sky_size):
+    """
+    The squared direction-cosine radius, l**2 + m**2, of each sky cell. Read-only.
+
+    See :meth:`CoreInstrumental.beam`.
+    """
+    sky_coords_lm = np.sin(np.linspace(-sky_size / 2, sky_size / 2, ncells))
+    lm2 = np.add.outer(sky_coords_lm ** 2, sky_coords_lm ** 2)
+
+    lm2.flags.writeable = False
+    return lm2
+
+
+class _Prefetcher:
+    """
+    Calls a function repeatedly in a background thread, keeping up to `size` of its results ready in a queue.
+
+    The thread blocks (rather than polls) while the queue is full, and runs until :meth:`close`, which is also called
+    when the prefetcher is used as a context manager.
+    """
+
+    def __init__(self, fnc, size):
+        self.queue = queue.Queue(maxsize=max(size, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(fnc,), daemon=True)
+        self._thread.start()
+
+    def _run(self, fnc):
+        while not self._stop.is_set():
+            try:
+                item = (fnc(), None)
+            except Exception as e:
+                item = (None, e)
+
+            # Blocks until a result is taken, or the queue is emptied by close().
+            self.queue.put(item)
+
+            # Stop at the first error, which is raised by get().
+            if item[1] is not None:
+                return
+
+    def get(self):
+        """
+        The next result, waiting for it if none is ready.
+        """
+        result, error = self.queue.get()
+        if error is not None:
+            raise error
+        return result
+
+    def close(self):
+        """
+        Stop the thread (once it has finished the result in progress), discarding the results not yet used. Calling
+        it again does nothing.
+        """
+        self._stop.set()
+
+        # Make room for the thread to put the result it may be blocked on, after which it sees the stop.
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _prefetched_foregrounds(core_ref, *args, **kwargs):
+    # Generate foregrounds for the prefetcher of a core, which it only refers to weakly, so that the thread does not
+    # keep the core alive.
+    core = core_ref()
+    if core is None:
+        raise ReferenceError("the CoreForegrounds of this prefetcher no longer exists")
+    return core._expanded_foregrounds(*args, **kwargs)
+
+
+def _check_bounds(x, grid):
+    """
+    Raise a ValueError if any of the points `x` lie outside the (increasing) `grid`.
+    """
+    if np.min(x) < grid[0] or np.max(x) > grid[-1]:
+        raise ValueError("One of the requested points is out of bounds of the grid.")
+
+
+def _linear_interp_weights(x, grid):
+    """
+    Find the lower cell index and linear interpolation weight of each point on a regular 1D grid.
+
+    Parameters
+    ----------
+    x : array
+        Points at which to interpolate. Must lie within the grid.
+
+    grid : 1D array
+        Regularly-spaced, monotonically increasing grid co-ordinates.
+
+    Returns
+    -------
+    indx : int array, same shape as `x`
+        The index of the grid point to the left of each point, in the range [0, len(grid) - 2].
+
+    weight : array, same shape as `x`
+        The fractional distance of each point from its left grid point (0 at the left, 1 at the right).
+    """
+    _check_bounds(x, grid)
+
+    dx = (grid[-1] - grid[0]) / (len(grid) - 1)
+    indx = np.clip(np.floor((x - grid[0]) / dx).astype(int), 0, len(grid) - 2)
+    weight = (x - grid[indx]) / dx
+
+    return indx, weight
+
 
 class CoreForegrounds:
     def __init__(self, pt_source_params={}, diffuse_params = {},  add_point_sources=True, add_diffuse=True, redshifts=None,
-                 boxsize=None, sky_cells = None):
+                 boxsize=None, sky_cells = None, freeze_foregrounds=False, frequencies=None, seed=None,
+                 disk_cache=None, prefetch=0, cache_realisations=False):
         """
         Setting up variables minimum and maximum flux
+
+        If `freeze_foregrounds` is True, a single realisation of the foregrounds is generated (on the first call,
+        once the lightcone geometry is known) and re-used at every step. Rather than being added to the EoR
+        lightcone, it is then passed separately in the context as "foreground_lightcone", which lets
+        :class:`CoreInstrumental` pass it through the (linear) instrument only once per chain.
+
+        If `frequencies` (in Hz) are given, typically the instrumental frequencies of :class:`CoreInstrumental`, the
+        EoR lightcone is linearly resampled onto them before anything else is done, and the foregrounds are generated
+        directly at them. All later stages (in particular the instrument) then work on ``len(frequencies)`` slices
+        rather than the full depth of the lightcone. This changes the order of the (linear) frequency interpolation
+        and the (frequency-dependent) beam and baseline sampling, and so is an approximation; see
+        ``devel/check_frequency_decimation.py`` for its accuracy.
+
+        All random numbers derive from `seed` (an int or :class:`numpy.random.SeedSequence`; by default, fresh
+        entropy which is logged so that the run can be replayed). The point sources of each step are drawn from
+        the Generator in the context as "rng" if there is one (eg. from :meth:`spawn`, one per walker or thread),
+        and otherwise from the core's own Generator, `rng`. The diffuse field has a fixed seed: 1234 if `seed` is
+        None, or else derived from `seed`, unless given in `diffuse_params`.
+
+        If a `disk_cache` (a :class:`~cache.DiskCache`, or the path of its directory) is given, the frozen
+        foregrounds are stored in it, keyed by a hash of the foreground parameters, grid, frequencies, diffuse seed
+        and the state of the Generator they are drawn from. Re-generating them (eg. on a rerun with the same seed)
+        then only loads them, lazily, and leaves the Generator in the state it would have had. Cached lightcones are
+        stored in full, so expanded in memory once when they are first generated. The realisations of each step
+        (without frozen foregrounds) are only cached if `cache_realisations` is also set: each step then writes a
+        full lightcone to disk, under a key which never repeats within a run, and a rerun only hits the entries
+        which have not yet been evicted, so this is only worthwhile if the cache can hold the whole run.
+
+        If `prefetch` is positive (and the foregrounds are not frozen), up to `prefetch` upcoming foreground
+        realisations are generated (and expanded into full lightcones) in a background thread, while the rest of
+        each step runs, and each call only takes the next one (see :meth:`prefetched_foregrounds`). They are drawn
+        in order from the thread's own Generator, a child of the core's seed sequence (see :meth:`spawn`), so they
+        are reproducible for a given seed, and independent of the timing of the thread and of other draws from
+        `rng` (such as frozen foregrounds). Steps with an "rng" in the context generate their foregrounds from it as
+        usual. Call :meth:`close` to stop the thread.
         """
         # print "Initializing the foreground core"
 
@@ -45,6 +255,52 @@ class CoreForegrounds:
         self.boxsize = boxsize
         self.sky_cells = sky_cells
 
+        self.frequencies = None if frequencies is None else np.asarray(frequencies, dtype=float)
+
+        self.freeze_foregrounds = freeze_foregrounds
+
+        # Cached stages: the frozen foreground realisation, which is fixed for a given lightcone geometry, and the
+        # operator resampling the lightcone onto `frequencies`.
+        self.stages = stages.StageGraph()
+        self.stages.add(
+            "frozen_foregrounds", partial(self.add_foregrounds, use_disk_cache=True),
+            ("sky_cells", "redshifts", "boxsize", "frequencies")
+        )
+        self.stages.add(
+            "resampling", CoreInstrumental.frequency_interpolation_matrix, ("freq_grid", "linear_freq")
+        )
+
+        self.disk_cache = cache.DiskCache(disk_cache) if isinstance(disk_cache, str) else disk_cache
+        self.cache_realisations = cache_realisations
+
+        self.seed_sequence = _seed_sequence(seed, "CoreForegrounds")
+        # The diffuse field is seeded from its own child of the seed sequence, independent of the Generator's stream.
+        # Without a seed, it keeps the historical fixed seed, so that all such cores (eg. of mock data and of a later
+        # chain) share the same diffuse sky.
+        diffuse_seed = int(self.seed_sequence.spawn(1)[0].generate_state(1)[0])
+        self.diffuse_seed = 1234 if seed is None else diffuse_seed
+        self.rng = np.random.default_rng(self.seed_sequence)
+
+        self.prefetch = prefetch
+        self._prefetcher = None
+        self._prefetch_key = None
+        self._prefetch_finalizer = None
+
+    def __getstate__(self):
+        # The background thread is not copied (eg. into the workers of a process pool); copies start their own.
+        state = self.__dict__.copy()
+        state["_prefetcher"] = state["_prefetch_finalizer"] = None
+        return state
+
+    def spawn(self, n):
+        """
+        Independent random Generators from the core's seed sequence, eg. one for each walker or thread.
+
+        Successive calls give new streams, in a reproducible order. Each may be passed to a step in the context, as
+        "rng".
+        """
+        return [np.random.default_rng(s) for s in self.seed_sequence.spawn(n)]
+
     def setup(self):
         print("Generating the foregrounds")
 
@@ -55,6 +311,15 @@ class CoreForegrounds:
         The net result of this function is to replace the EoR lightcone in the "output" variable of the context with
         a foreground-contaminated version with the same shape (but in Jy/sr rather than mK). It also adds the
         variables "frequencies" and "sky_size".
+
+        If `freeze_foregrounds` is set (and there is an EoR lightcone), the EoR lightcone is only converted to Jy/sr,
+        and the frozen foregrounds are instead added to the context as "foreground_lightcone".
+
+        If `frequencies` is set, the output lightcone (and its "redshifts_slices") is at those frequencies rather than
+        those of the EoR lightcone.
+
+        If the context has an "rng", the point sources are drawn from it, rather than from the core's Generator.
+        Otherwise, if `prefetch` is set, the next of the realisations generated in the background is used.
         """
         print("Getting the simulation data")
 
@@ -69,25 +334,188 @@ class CoreForegrounds:
             boxsize = self.boxsize
             sky_cells = self.sky_cells
 
-        fg_lightcone, frequencies, sky_size = self.add_foregrounds(sky_cells, redshifts, boxsize)
+        if self.frequencies is not None and eor is not None:
+            eor_frequencies = conversions.F21 / (1 + redshifts)
+            eor_lightcone = self.resample_lightcone(
+                eor_lightcone, eor_frequencies, self.frequencies,
+                interp=self.stages["resampling"](freq_grid=eor_frequencies, linear_freq=self.frequencies)
+            )
+            ctx.get("output").lightcone_box = eor_lightcone
+
+        if self.freeze_foregrounds:
+            fg_lightcone, frequencies, sky_size = self.frozen_foregrounds(sky_cells, redshifts, boxsize)
+        elif self.prefetch and ctx.get("rng", None) is None:
+            fg_lightcone, frequencies, sky_size = self.prefetched_foregrounds(sky_cells, redshifts, boxsize)
+        else:
+            fg_lightcone, frequencies, sky_size = self.add_foregrounds(
+                sky_cells, redshifts, boxsize, frequencies=self.frequencies, rng=ctx.get("rng", None)
+            )
+
+        if self.frequencies is not None:
+            redshifts = conversions.F21 / frequencies - 1
+            if eor is not None:
+                ctx.get("output").redshifts_slices = redshifts
 
         if eor is None:
-            ctx.add("output", LightCone(redshifts, fg_lightcone, fg_lightcone.shape[0], boxsize))
+            ctx.add("output", LightCone(redshifts, np.asarray(fg_lightcone), sky_cells, boxsize))
             print("Added lightcone")
             ctx.get('output').redshifts_slices = redshifts
         else:
             # Replace the EoR lightcone with the new lightcone
             # Make sure we convert from mK to Jy before summing!
             eor_lightcone *= self.conversion_factor_K_to_Jy()
-            ctx.get("output").lightcone_box += fg_lightcone
+
+            if self.freeze_foregrounds:
+                ctx.add("foreground_lightcone", fg_lightcone)
+            else:
+                fg_lightcone.add_to(ctx.get("output").lightcone_box)
 
         ctx.add("frequencies", frequencies)
         ctx.add("sky_size", sky_size)
 
-    def add_foregrounds(self, sky_cells, redshifts, boxsize):
+    def add_foregrounds_batch(self, lightcones, redshifts, boxsize, rng=None):
+        """
+        Apply foregrounds to a stack of EoR lightcones (eg. one per walker), as :meth:`__call__` does to one.
+
+        Each lightcone is converted to Jy/sr and, unless `freeze_foregrounds` is set, gets its own foreground
+        realisation. The result can be passed straight to :meth:`CoreInstrumental.add_instrument`.
+
+        Parameters
+        ----------
+        lightcones : (nwalkers, ncells, ncells, nslices)-array
+            The EoR lightcones, in mK. Unless `frequencies` is set (in which case they are resampled onto a new
+            array), they are modified in-place.
+
+        redshifts : (nslices,)-array
+            The redshifts of the lightcone slices.
+
+        boxsize : float
+            The transverse size of the lightcones, in Mpc.
+
+        rng : :class:`numpy.random.Generator`, optional
+            The Generator from which the foregrounds of each lightcone are drawn in turn. By default, the core's own.
+
+        Returns
+        -------
+        lightcones : (nwalkers, ncells, ncells, nfreq)-array
+            The foreground-contaminated lightcones, in Jy/sr.
+
+        frequencies : (nfreq,)-array
+            The frequencies of the lightcone slices.
+
+        sky_size : float
+            The angular size of the lightcones, in radians.
+
+        foregrounds : :class:`~sky.Sky` or None
+            If `freeze_foregrounds` is set, the frozen foregrounds (which have *not* been added to `lightcones`).
+            Otherwise, None.
+        """
+        sky_cells = lightcones.shape[1]
+
+        if self.frequencies is not None:
+            frequencies = conversions.F21 / (1 + redshifts)
+            lightcones = self.resample_lightcone(
+                lightcones, frequencies, self.frequencies,
+                interp=self.stages["resampling"](freq_grid=frequencies, linear_freq=self.frequencies)
+            )
+
+        lightcones *= self.conversion_factor_K_to_Jy()
+
+        if self.freeze_foregrounds:
+            foregrounds, frequencies, sky_size = self.frozen_foregrounds(sky_cells, redshifts, boxsize)
+            return lightcones, frequencies, sky_size, foregrounds
+
+        for lightcone in lightcones:
+            fg_lightcone, frequencies, sky_size = self.add_foregrounds(
+                sky_cells, redshifts, boxsize, frequencies=self.frequencies, rng=rng
+            )
+            fg_lightcone.add_to(lightcone)
+
+        return lightcones, frequencies, sky_size, None
+
+    def frozen_foregrounds(self, sky_cells, redshifts, boxsize):
+        """
+        Return a single, fixed realisation of the foregrounds for the given lightcone geometry.
+
+        The realisation is generated with :meth:`add_foregrounds` the first time this is called (or whenever the
+        geometry changes), and the same sky is returned thereafter (it is the "frozen_foregrounds" stage).
+
+        Parameters
+        ----------
+        sky_cells, redshifts, boxsize :
+            See :meth:`add_foregrounds`.
+
+        Returns
+        -------
+        lightcone, frequencies, sky_size :
+            See :meth:`add_foregrounds`.
+        """
+        return self.stages["frozen_foregrounds"](
+            sky_cells=sky_cells, redshifts=redshifts, boxsize=boxsize, frequencies=self.frequencies
+        )
+
+    def prefetched_foregrounds(self, sky_cells, redshifts, boxsize):
+        """
+        Return the next of the foreground realisations generated in a background thread (see `prefetch`).
+
+        The thread is started on the first call, and restarted (discarding the realisations already generated)
+        whenever the lightcone geometry changes. Each thread draws its realisations from its own Generator, spawned
+        from the core's seed sequence when it starts, so it never shares a Generator with the calling thread. Each
+        realisation is expanded into a full lightcone in the background, so that adding it to the EoR lightcone is
+        all that is left to do.
+
+        Parameters
+        ----------
+        sky_cells, redshifts, boxsize :
+            See :meth:`add_foregrounds`.
+
+        Returns
+        -------
+        lightcone, frequencies, sky_size :
+            See :meth:`add_foregrounds`. The lightcone is a :class:`~sky.ArraySky`.
+        """
+        key = self._prefetch_key
+        if self._prefetcher is None or not (
+                key[0] == sky_cells and key[2] == boxsize and np.array_equal(key[1], redshifts)):
+            self.close()
+            self._prefetch_key = (sky_cells, np.array(redshifts), boxsize)
+            self._prefetcher = _Prefetcher(
+                partial(
+                    _prefetched_foregrounds, weakref.ref(self), sky_cells, self._prefetch_key[1], boxsize,
+                    rng=self.spawn(1)[0]
+                ),
+                self.prefetch
+            )
+
+            # Stop the thread if the core is garbage collected without being closed.
+            self._prefetch_finalizer = weakref.finalize(self, self._prefetcher.close)
+
+        return self._prefetcher.get()
+
+    def _expanded_foregrounds(self, sky_cells, redshifts, boxsize, rng=None):
+        fg_sky, frequencies, sky_size = self.add_foregrounds(
+            sky_cells, redshifts, boxsize, frequencies=self.frequencies, rng=rng
+        )
+        return sky.ArraySky(np.asarray(fg_sky)), frequencies, sky_size
+
+    def close(self):
+        """
+        Stop generating foregrounds in the background (see `prefetch`). Realisations which were generated but not
+        used are discarded. Also called on leaving a ``with`` block, or when the core is garbage collected.
+        """
+        if self._prefetcher is not None:
+            self._prefetch_finalizer()
+            self._prefetcher = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_foregrounds(self, sky_cells, redshifts, boxsize, frequencies=None, rng=None, use_disk_cache=None):
         """
-        A function which creates foregrounds (both point-sources and diffuse) and adds them to an existing lightcone.
-        It also changes the units from mK to Jy/sr.
+        A function which creates foregrounds (both point-sources and diffuse), in units of Jy/sr.
 
         Parameters
         ----------
@@ -100,13 +528,26 @@ class CoreForegrounds:
         boxsize : float
             The size of the EoR lightcone (in transverse direction) in Mpc
 
+        frequencies : array, optional
+            The frequencies (in Hz) at which to generate the foregrounds. By default, those corresponding to
+            `redshifts`. The sky size is always that of the EoR lightcone at `redshifts`.
+
+        rng : :class:`numpy.random.Generator`, optional
+            The Generator from which to draw the point sources. By default, the core's own.
+
+        use_disk_cache : bool, optional
+            Whether to load the foregrounds from (or store them in) the `disk_cache`, if there is one. By default,
+            only if `cache_realisations` is set. Frozen foregrounds always use it.
+
         Returns
         -------
-        sky : (sky_cells, sky_cells, nredshifts)-array
-            A box containing both the EoR signal and the foregrounds, in units of Jy/sr
+        sky : :class:`~sky.Sky`
+            The foregrounds, of shape (sky_cells, sky_cells, nredshifts) and in units of Jy/sr. They are kept as a sum
+            of separable terms, and may be expanded (eg. with ``np.asarray``), indexed a slab at a time, or added
+            to an existing lightcone with ``sky.add_to(lightcone)``.
         
         frequencies : (nredshifts,)-array
-            The frequencies (in Hz) corresponding to the input redshifts.
+            The frequencies (in Hz) corresponding to the input redshifts (or the input frequencies, if given).
 
         sky_size : float
             The length of the box (in transverse direction) in radians, at the mean redshift.
@@ -120,37 +561,92 @@ class CoreForegrounds:
         sky_size = self.get_sky_size(boxsize, redshifts)
 
         # Note, don't flip the frequencies here, rather do it only when necessary.
-        frequencies = 1420e6 / (redshifts + 1)
+        if frequencies is None:
+            frequencies = 1420e6 / (redshifts + 1)
 
-        lightcone = np.zeros((sky_cells, sky_cells, len(redshifts)))
+        rng = self.rng if rng is None else rng
 
-        if self.add_diffuse:
-            # We add it here, because it's easier to add in mK
-            lightcone += self.diffuse(frequencies, sky_cells, sky_size, **self.diffuse_params)
+        if use_disk_cache is None:
+            use_disk_cache = self.cache_realisations
 
-        # Change the units of brightness temperature from mK to Jy/sr
-        lightcone *= self.conversion_factor_K_to_Jy()
+        key = None
+        if use_disk_cache and self.disk_cache is not None and hasattr(rng, "bit_generator"):
+            key = self.disk_cache.key(
+                "foregrounds", self.pt_source_params, self.diffuse_params, self.add_point_sources, self.add_diffuse,
+                sky_cells, sky_size, frequencies, self.diffuse_seed, rng.bit_generator.state
+            )
+            arrays, meta = self.disk_cache.get(key)
+            if arrays is not None:
+                # Leave the Generator as if the point sources had been drawn.
+                rng.bit_generator.state = meta["rng_state"]
+                return sky.ArraySky(arrays["sky"]), frequencies, sky_size
+
+        components = []
 
+        if self.add_diffuse:
+            # Change the units of brightness temperature from mK to Jy/sr
+            diffuse_params = dict({"seed": self.diffuse_seed}, **self.diffuse_params)
+            components.append(self.diffuse(frequencies, sky_cells, sky_size, **diffuse_params) * \
+                              self.conversion_factor_K_to_Jy())
 
         # Interpolate linearly in frequency (POSSIBLY IN RADIAN AS WELL)
         # TODO: I don't think we need to do this, as we can interpolate in the Instrumenal class.
         # linLightcone, linFrequencies = self.interpolate_freqs(EoR_lightcone, frequencies)
 
-        # Generate the point sources foregrounds and
-        # TODO: this has no dependence on spectral index!!!
+        # Generate the point sources foregrounds
         if self.add_point_sources:
-            lightcone += np.repeat(
-                self.point_sources(
-                    frequencies=frequencies, sky_cells = sky_cells, sky_size=sky_size, **self.pt_source_params
-                ),
-                np.shape(lightcone)[2], axis=2
-            )
+            components.append(self.point_sources(
+                frequencies=frequencies, sky_cells=sky_cells, sky_size=sky_size, rng=rng, **self.pt_source_params
+            ))
+
+        if components:
+            fg_sky = sky.CompositeSky(components)
+        else:
+            fg_sky = sky.SeparableSky(np.zeros((sky_cells, sky_cells)), np.zeros(len(frequencies)))
 
-        return lightcone, frequencies, sky_size
+        if key is not None:
+            self.disk_cache.put(key, {"sky": fg_sky}, rng_state=rng.bit_generator.state)
+
+        return fg_sky, frequencies, sky_size
+
+    @staticmethod
+    def resample_lightcone(lightcone, frequencies, new_frequencies, interp=None):
+        """
+        Linearly interpolate a lightcone onto a new set of frequencies.
+
+        Parameters
+        ----------
+        lightcone : (..., ncells, ncells, nfreq)-array
+            The lightcone (or a stack of them).
+
+        frequencies : (nfreq,)-array
+            The frequencies of the lightcone slices.
+
+        new_frequencies : (N,)-array
+            The frequencies onto which to interpolate. Must lie within the range of `frequencies`.
+
+        interp : sparse (nfreq, N)-matrix, optional
+            The interpolation operator (see :meth:`CoreInstrumental.frequency_interpolation_matrix`), if already
+            computed.
+
+        Returns
+        -------
+        lightcone : (..., ncells, ncells, N)-array
+            The resampled lightcone.
+        """
+        if interp is None:
+            interp = CoreInstrumental.frequency_interpolation_matrix(frequencies, new_frequencies)
+        shape = np.shape(lightcone)
+
+        return np.asarray(np.reshape(lightcone, (-1, shape[-1])) @ interp).reshape(shape[:-1] + (len(new_frequencies),))
 
     @staticmethod
     def get_sky_size(boxsize, redshifts):
-        return 2 * np.arctan(boxsize / (2 * cosmo.comoving_transverse_distance([np.mean(redshifts)]).value))
+        """
+        The angular size of the box (in radians) at the mean redshift. The cosmological distance is memoized, so
+        this is cheap to call repeatedly for the same redshifts.
+        """
+        return conversions.sky_size(boxsize, np.mean(redshifts))
 
 
     # def interpolate_freqs(self, data, frequencies, uv_range=100):
@@ -189,7 +685,9 @@ class CoreForegrounds:
     #     return interpData, linFrequencies
 
     @staticmethod
-    def point_sources(frequencies, sky_cells, sky_size, S_min=1e-1, S_max=1.0, alpha=4100., beta=1.59):
+    def point_sources(frequencies, sky_cells, sky_size, S_min=1e-1, S_max=1.0, alpha=4100., beta=1.59,
+                      spectral_index=0.0, spectral_index_std=0.0, nu0=150e6, S_faint=None, faint_method="gaussian",
+                      rng=None):
         """
         Create a grid of flux densities corresponding to a sample of point-sources drawn from a power-law source count
         model.
@@ -210,10 +708,41 @@ class CoreForegrounds:
         alpha
         beta
 
+        spectral_index : float, optional
+            The (mean) spectral index of the sources, such that flux scales as ``(nu/nu0)**(-spectral_index)``.
+
+        spectral_index_std : float, optional
+            If non-zero, each source is given its own spectral index, drawn from a normal distribution with this
+            standard deviation.
+
+        nu0 : float, optional
+            The reference frequency (in Hz) at which the fluxes are drawn.
+
+        S_faint : float, optional
+            If given (and greater than `S_min`), only sources brighter than `S_faint` are drawn individually. The
+            unresolved population between `S_min` and `S_faint` is instead generated directly as a gridded field
+            with :meth:`faint_sources`, with a cost that scales with the number of cells rather than sources. It
+            is given the mean `spectral_index`.
+
+        faint_method : {"gaussian", "poisson"}, optional
+            How to generate the unresolved population (see :meth:`faint_sources`).
+
+        rng : :class:`numpy.random.Generator`, optional
+            The source of random numbers. By default, numpy's global random state.
+
         Returns
         -------
-
+        sky : :class:`~sky.Sky`
+            The point-source sky, in Jy/sr, of shape (sky_cells, sky_cells, len(frequencies)). It is only expanded
+            to a full cube a slab of frequencies at a time.
         """
+        rng = np.random if rng is None else rng
+
+        # Only draw the sources above S_faint individually
+        S_lim = S_min
+        if S_faint is not None and S_faint > S_min:
+            S_min = min(S_faint, S_max)
+
         # Create a function for source count distribution
         source_count = lambda x: alpha * x ** (-beta)
 
@@ -221,23 +750,92 @@ class CoreForegrounds:
         n_bar = quad(source_count, S_min, S_max)[0]
 
         # Generate the number of sources following poisson distribution
-        N_sources = np.random.poisson(n_bar)
+        N_sources = rng.poisson(n_bar)
 
         # Generate the point sources in unit of Jy and position using uniform distribution
-        fluxes = ((S_max ** (1 - beta) - S_min ** (1 - beta)) * np.random.uniform(size=N_sources) + S_min ** (
+        fluxes = ((S_max ** (1 - beta) - S_min ** (1 - beta)) * rng.uniform(size=N_sources) + S_min ** (
                     1 - beta)) ** (1 / (1 - beta))
-        pos = np.rint(np.random.uniform(0, sky_cells - 1, size=(N_sources, 2))).astype(int)
+        pos = np.rint(rng.uniform(0, sky_cells - 1, size=(N_sources, 2))).astype(int)
 
-        # Create an empty array and fill it up by adding the point sources
-        sky = np.zeros((sky_cells, sky_cells, 1))
+        mean_index = spectral_index
+        if spectral_index_std:
+            spectral_index = rng.normal(spectral_index, spectral_index_std, size=N_sources)
 
-        for ii in range(N_sources):
-            sky[pos[ii, 0], pos[ii, 1]] += fluxes[ii]
+        # Generate the unresolved sources as a whole field
+        background = None
+        if S_lim < S_min:
+            background = CoreForegrounds.faint_sources(
+                sky_cells, S_lim, S_min, alpha, beta, method=faint_method, rng=rng
+            )
+            background /= (sky_size / sky_cells) ** 2
 
         # Divide by area of each sky cell; Jy/sr
-        sky /= (sky_size / sky_cells)**2
+        fluxes /= (sky_size / sky_cells) ** 2
 
-        return sky
+        # Deposit all sources at once, on flat cell indices
+        return sky.point_source_sky(
+            pos[:, 0] * sky_cells + pos[:, 1], fluxes, frequencies, sky_cells, spectral_index=spectral_index, nu0=nu0,
+            background=background, background_index=mean_index
+        )
+
+    @staticmethod
+    def faint_sources(sky_cells, S_min, S_max, alpha=4100., beta=1.59, method="gaussian", rng=None):
+        """
+        Generate the total flux density in each sky cell of a population of (faint) point-sources, without drawing
+        the sources individually.
+
+        The sources follow the same power-law source counts and distribution of positions as in
+        :meth:`point_sources`, so that the total flux in a cell is a compound-Poisson variable with mean
+        :math:`\lambda \langle S \rangle` and variance :math:`\lambda \langle S^2 \rangle`, where
+        :math:`\lambda` is the expected number of sources in the cell.
+
+        Parameters
+        ----------
+        sky_cells : int
+            Number of cells on a side for the 2 sky dimensions.
+
+        S_min, S_max, alpha, beta : float
+            Parameters of the source counts (see :meth:`point_sources`).
+
+        method : {"gaussian", "poisson"}, optional
+            With "gaussian", the total flux in each cell is drawn from a normal distribution with the exact mean and
+            variance. With "poisson", the number of sources in each cell is drawn from a Poisson distribution, and
+            their total flux from a normal distribution with the exact conditional mean and variance. The latter
+            retains the shot noise of cells with few sources (eg. it is exactly zero in empty cells).
+
+        rng : :class:`numpy.random.Generator`, optional
+            The source of random numbers. By default, numpy's global random state.
+
+        Returns
+        -------
+        sky : (sky_cells, sky_cells)-array
+            The total flux density (in Jy) in each cell.
+        """
+        rng = np.random if rng is None else rng
+        source_count = lambda x: alpha * x ** (-beta)
+
+        # Number of sources and first two moments of their total flux, over the whole sky
+        n_bar = quad(source_count, S_min, S_max)[0]
+        s1 = quad(lambda x: x * source_count(x), S_min, S_max)[0]
+        s2 = quad(lambda x: x ** 2 * source_count(x), S_min, S_max)[0]
+
+        # Fraction of sources in each cell. Positions in point_sources are rounded from uniform(0, sky_cells - 1),
+        # so the edge cells of each axis get half the share of the others.
+        w = np.ones(sky_cells)
+        w[[0, -1]] = 0.5
+        w /= w.sum()
+        frac = np.outer(w, w)
+
+        if method == "gaussian":
+            return frac * s1 + np.sqrt(frac * s2) * rng.normal(size=frac.shape)
+        elif method == "poisson":
+            mean_flux = s1 / n_bar
+            var_flux = s2 / n_bar - mean_flux ** 2
+
+            counts = rng.poisson(frac * n_bar)
+            return counts * mean_flux + np.sqrt(counts * var_flux) * rng.normal(size=frac.shape)
+        else:
+            raise ValueError("faint_method must be 'gaussian' or 'poisson', got '%s'" % method)
 
     @staticmethod
     def diffuse(frequencies, ncells, sky_size,
@@ -245,7 +843,8 @@ class CoreForegrounds:
                 eta = 0.01,
                 rho = -2.7,
                 mean_temp=253e3,
-                kappa=-2.55):
+                kappa=-2.55,
+                seed=1234):
         """
         This creates diffuse structure according to Eq. 55 from Trott+2016.
 
@@ -263,10 +862,15 @@ class CoreForegrounds:
         u0, eta, rho, mean_temp, kappa : float, optional
             Parameters of the diffuse sky model (see notes)
 
+        seed : int, optional
+            The seed of the lognormal density field.
+
         Returns
         -------
-        Tbins : (ncells, ncells, nfreq)- array
-            Brightness temperature of the diffuse emission, in mK.
+        Tbins : :class:`~sky.SeparableSky`
+            Brightness temperature of the diffuse emission, in mK, of shape (ncells, ncells, nfreq). This is the
+            density field times the mean temperature at each frequency, which is only expanded a slab of frequencies
+            at a time.
 
 
         Notes
@@ -274,26 +878,18 @@ class CoreForegrounds:
         The box is populated with a lognormal field with power spectrum given by
 
         .. math:: \left(\frac{2k_B}{\lambda^2}\right)^2 \Omega (eta \bar{T}_B) \left(\frac{u}{u_0}\right)^{\rho} \left(\frac{\nu}{100 {\rm MHz}}\right)^{\kappa}
+
+        The density field is generated with a fixed seed, so it depends only on (ncells, sky_size, u0, eta, rho, seed).
+        The most recent :data:`DIFFUSE_CACHE_SIZE` fields are cached.
         """
 
         # Calculate mean flux density per frequency. Remember to take the square root because the Power is squared.
         Tbar = np.sqrt((frequencies/1e8)**kappa * mean_temp**2)
-        power_spectrum = lambda  u : eta**2 * (u/u0) ** rho
 
-        # Create a log normal distribution of fluctuations
-        pb = LogNormalPowerBox(N=ncells, pk=power_spectrum, dim=2, boxlength=sky_size[0], a=0, b=2 * np.pi, seed=1234)
-
-        density = pb.delta_x() + 1
+        density = _diffuse_density(int(ncells), float(sky_size), float(u0), float(eta), float(rho), int(seed))
 
         # Multiply the inherent fluctuations by the mean flux density.
-        if np.std(density)>0:
-            Tbins = np.outer(density, Tbar).reshape((ncells, ncells, len(frequencies)))
-        else:
-            Tbins = np.zeros((ncells, ncells, len(frequencies)))
-            for i in range(len(frequencies)):
-                Tbins[:, :, i] = Tbar[i]
-
-        return Tbins
+        return sky.SeparableSky(density, Tbar)
 
     @staticmethod
     def conversion_factor_K_to_Jy(nu=None):
@@ -312,12 +908,8 @@ class CoreForegrounds:
         """
         # Can either do it with the beam or without the beam (frequency dependent)
         if nu is None:
-            # TODO: unfortunately, this is instrument-dependent and so should really go in the instrumental core
-            A_eff = 20 * un.m ** 2
-
-            flux_density = (2 * 1e26 * const.k_B * 1e-3 * un.K / (A_eff * (1 * un.Hz) * (1 * un.s))).to(
-                un.W / (un.Hz * un.m ** 2))
-
+            # This is constant, so is only evaluated once.
+            return conversions.K_to_Jy()
         else:
             flux_density = (2 * const.k_B * 1e-3 * un.K / (((const.c) / (nu.to(1 / un.s))) ** 2) * 1e26).to(
                 un.W / (un.Hz * un.m ** 2))
@@ -327,7 +919,10 @@ class CoreForegrounds:
 
 class CoreInstrumental:
     def __init__(self, antenna_posfile, freq_min, freq_max, nfreq, tile_diameter=4.0, max_bl_length=150.0,
-                 integration_time=1200, Tsys = 0):
+                 integration_time=1200, Tsys = 0, slab_size=None, fft_backend="numpy", fft_threads=1,
+                 redundancy_tol=None, sampling="grid", nufft_eps=1e-6, beam_mode="cached", beam_dtype=np.float64,
+                 beam_cache_max=2**30, seed=None, disk_cache=None, effective_area=20.0, noise_dtype=np.complex64,
+                 sampling_cache_size=2):
         """
         Core MCMC class which converts 21cmFAST *lightcone* output into a mock observation, sampled at specific baselines.
 
@@ -354,13 +949,156 @@ class CoreInstrumental:
 
         integration_time : float,optional
             The length of the observation, in seconds.
+
+        Tsys : float or (nfreq,)-array, optional
+            The system temperature (per instrumental frequency), in K. The rms thermal noise of each visibility is
+            derived from it by the radiometer equation (see :meth:`thermal_noise_sigma`).
+
+        slab_size : int, optional
+            The number of lightcone slices (frequencies) to pass through the instrument at a time. Peak memory is
+            then set by the slab size rather than the depth of the lightcone (which may also be a ``np.memmap``).
+            By default, the whole lightcone is processed at once.
+
+        fft_backend : {"numpy", "scipy", "pyfftw"}, optional
+            The library used for the spatial FFT (see :func:`~dft.get_backend`).
+
+        fft_threads : int, optional
+            The number of threads used by the FFT backend (if it supports more than one). If None, use all CPUs.
+
+        redundancy_tol : float, optional
+            If given, baselines which are equal to within this tolerance (in metres) are grouped into a single
+            (mean) baseline, and their multiplicity is passed in the context as "baseline_weights", to be used when
+            gridding. Visibilities are then only computed once per redundant group (see
+            :meth:`group_redundant_baselines`). Only applies to baselines read from an antenna file.
+
+        sampling : {"grid", "nufft"}, optional
+            How the visibilities are evaluated at the baselines. With "grid", the sky is FFT'd onto a regular UV grid,
+            which is bilinearly interpolated onto the baselines (see :meth:`sample_onto_baselines`). With "nufft", the
+            Fourier transform of the sky is evaluated directly at each baseline with a non-uniform FFT (see
+            :meth:`sample_nufft`). The latter does not suffer from interpolation error (which is largest for long
+            baselines), at the cost of a larger FFT.
+
+        nufft_eps : float, optional
+            The relative accuracy of the "nufft" sampling. Larger values are faster.
+
+        beam_mode : {"cached", "separable"}, optional
+            How the beam is applied to the sky (see :meth:`apply_beam`). With "cached", the full beam cube is computed
+            once for each set of lightcone frequencies, and kept on the instance (as long as it is smaller than
+            `beam_cache_max` bytes). With "separable", the beam of each frequency is formed from a cached map of
+            l**2 + m**2 as it is applied, so the beam cube is never built.
+
+        beam_dtype : dtype, optional
+            The precision of the beam, and of the beam-weighted sky. Use ``np.float32`` to halve their memory.
+
+        beam_cache_max : int, optional
+            The largest beam cube (in bytes) to cache in "cached" mode. Larger beams are applied as in "separable"
+            mode.
+
+        seed : int or :class:`numpy.random.SeedSequence`, optional
+            The seed of the thermal noise. By default, fresh entropy is used (and logged, so that the run can be
+            replayed). The noise of each step is drawn from the Generator in the context as "rng" if there is one
+            (eg. from :meth:`spawn`), and otherwise from the core's own Generator, `rng`.
+
+        disk_cache : :class:`~cache.DiskCache` or str, optional
+            A persistent cache (or the path of its directory) of the UV planes of frozen foregrounds (see
+            :meth:`uv_plane`), so that a rerun does not need to FFT them again. The UV planes of the EoR lightcone,
+            which changes at every step, are never cached.
+
+        effective_area : float, optional
+            The effective collecting area of a tile, in m^2, for the thermal noise.
+
+        noise_dtype : {np.complex64, np.complex128}, optional
+            The precision in which thermal noise is drawn. It is added to the visibilities in their own precision.
+
+        sampling_cache_size : int, optional
+            The number of UV sampling operators (see :meth:`sampling_operator`) kept on the instance, one for each set
+            of frequencies (ie. each slab). An operator is several times larger than the slab it samples, so only
+            the latest few are kept; with more slabs than this, they are re-built at each step. If None, all are kept.
         """
+        if sampling not in ("grid", "nufft"):
+            raise ValueError("sampling must be 'grid' or 'nufft', got '%s'" % sampling)
+        if beam_mode not in ("cached", "separable"):
+            raise ValueError("beam_mode must be 'cached' or 'separable', got '%s'" % beam_mode)
+
         self.antenna_posfile = antenna_posfile
         self.instrumental_frequencies = np.linspace(freq_min*1e6, freq_max*1e6, nfreq)
         self.tile_diameter = tile_diameter * un.m
         self.max_bl_length = max_bl_length
         self.integration_time = integration_time
         self.Tsys = Tsys
+        self.slab_size = slab_size
+        self.fft_backend = fft_backend
+        self.fft_threads = fft_threads
+        self.redundancy_tol = redundancy_tol
+        self.baseline_weights = None
+        self.sampling = sampling
+        self.nufft_eps = nufft_eps
+        self.beam_mode = beam_mode
+        self.beam_dtype = np.dtype(beam_dtype)
+        self.beam_cache_max = beam_cache_max
+        self.effective_area = effective_area
+        self.noise_dtype = np.dtype(noise_dtype)
+
+        # The rms noise of each visibility (set in setup), and the buffers into which the noise of each step is
+        # drawn, one per thread (so that threads calling add_instrument at once don't overwrite each other's noise).
+        self.noise_sigma = None
+        self._noise_buffers = threading.local()
+
+        # Cached stages, which are fixed for a given lightcone geometry: the visibilities of frozen foregrounds (see
+        # CoreForegrounds), the frequency interpolation operator, the beam cube, and the operators sampling the UV
+        # plane onto the baselines (for the latest few slabs of frequencies).
+        self.stages = stages.StageGraph()
+        self.stages.add(
+            "foreground_visibilities", self._foreground_response, ("lightcone", "frequencies", "sky_size")
+        )
+        self.stages.add(
+            "frequency_interpolation", self.frequency_interpolation_matrix, ("freq_grid", "linear_freq")
+        )
+        self.stages.add("beam", self._beam_cube, ("frequencies", "ncells", "sky_size"))
+        self.stages.add(
+            "sampling", self.sampling_matrix, ("frequencies", "uv", "baselines", "hermitian"),
+            maxsize=sampling_cache_size
+        )
+
+        self.disk_cache = cache.DiskCache(disk_cache) if isinstance(disk_cache, str) else disk_cache
+
+        self.seed_sequence = _seed_sequence(seed, "CoreInstrumental")
+        self.rng = np.random.default_rng(self.seed_sequence)
+
+    def __getstate__(self):
+        # The noise buffers are scratch space, so are not copied (eg. into the workers of a process pool).
+        state = self.__dict__.copy()
+        del state["_noise_buffers"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._noise_buffers = threading.local()
+
+    def spawn(self, n):
+        """
+        Independent random Generators from the core's seed sequence, eg. one for each walker or thread.
+
+        Successive calls give new streams, in a reproducible order. Each may be passed to a step in the context, as
+        "rng".
+        """
+        return [np.random.default_rng(s) for s in self.seed_sequence.spawn(n)]
+
+    def share(self, pool):
+        """
+        Move the fixed arrays of the instrument (its baselines, their weights and the instrumental frequencies) into
+        shared memory, so that they are pickled (eg. into the workers of a process pool) as lightweight handles.
+
+        Call after :meth:`setup`. Baselines are then plain arrays, in metres.
+
+        Parameters
+        ----------
+        pool : :class:`~shared.SharedMemoryPool`
+            The pool which owns the shared memory.
+        """
+        for name in ("baselines", "baseline_weights", "instrumental_frequencies"):
+            if getattr(self, name, None) is not None:
+                setattr(self, name, pool.share(getattr(self, name)))
 
     def setup(self):
         """
@@ -374,22 +1112,36 @@ class CoreInstrumental:
             data_path = path.join(path.dirname(__file__), 'data', self.antenna_posfile+'.txt')
 
             if path.exists(data_path):
-                ant_pos = np.genfromtxt(data_path, float)
+                ant_pos = self.read_antenna_positions(data_path)
             else:
-                ant_pos = np.genfromtxt(self.antenna_posfile, float)
+                ant_pos = self.read_antenna_positions(self.antenna_posfile)
 
-
-            # Find all the possible combination of tile displacement
+            # Find all the possible combination of tile displacement, up to the maximum length.
             # baselines is a dim2 array of x and y displacements.
-            self.baselines = self.get_baselines(ant_pos[:, 1], ant_pos[:, 2]) * un.m
+            self.baselines = self.get_baselines(ant_pos[:, 1], ant_pos[:, 2], max_length=self.max_bl_length) * un.m
+
+            if self.redundancy_tol:
+                baselines, self.baseline_weights = self.group_redundant_baselines(
+                    self.baselines.value, self.redundancy_tol
+                )
+                self.baselines = baselines * un.m
 
-            self.baselines = self.baselines[
-                self.baselines[:, 0].value ** 2 + self.baselines[:, 1].value ** 2 <= self.max_bl_length ** 2]
+        self.noise_sigma = self.thermal_noise_sigma(
+            self.instrumental_frequencies, self.integration_time, self.Tsys, self.effective_area,
+            self.baseline_weights
+        )
 
     def __call__(self, ctx):
         """
         Generate a set of realistic visibilities (i.e. the output we expect from an interferometer) and add it to the
         context. Also, add the linear frequencies of the observation to the context.
+
+        If the context contains a "foreground_lightcone" (i.e. the :class:`CoreForegrounds` has frozen foregrounds),
+        it is passed through the instrument only the first time it is seen, and its visibilities are added to those
+        of the lightcone at each step.
+
+        If the context has an "rng", the thermal noise is drawn from it, rather than from the core's Generator. The
+        rms of the noise of each visibility is added to the context as "noise_sigma".
         """
         lightcone = ctx.get("output").lightcone_box
         boxsize = ctx.get("output").box_len
@@ -399,40 +1151,181 @@ class CoreInstrumental:
         frequencies = ctx.get("frequencies", 1420e6/(1+redshifts))
         sky_size = ctx.get("sky_size", CoreForegrounds.get_sky_size(boxsize, redshifts))
 
-        vis = self.add_instrument(lightcone, frequencies, sky_size)
+        vis = self.add_instrument(
+            lightcone, frequencies, sky_size, foregrounds=ctx.get("foreground_lightcone", None),
+            rng=ctx.get("rng", None)
+        )
 
         ctx.add("visibilities", vis)
         ctx.add("baselines", self.baselines)
+        ctx.add("baseline_weights", self.baseline_weights)
         ctx.add("frequencies", self.instrumental_frequencies)
+        ctx.add("noise_sigma", self.noise_sigma)
 
-    def add_instrument(self, lightcone, frequencies, sky_size):
-        # Number of 2D cells in sky array
-        sky_cells = np.shape(lightcone)[0]
+    def add_instrument(self, lightcone, frequencies, sky_size, foregrounds=None, rng=None):
+        """
+        Convert a sky lightcone into noisy visibilities at the instrumental baselines and frequencies.
+
+        Parameters
+        ----------
+        lightcone : (ncells, ncells, nfreq)- or (nwalkers, ncells, ncells, nfreq)-array
+            The sky brightness, in Jy/sr. A stack of lightcones (eg. one per walker) is passed through the instrument
+            in the same vectorised calls (see :meth:`instrument_response`).
+
+        frequencies : (nfreq,)-array
+            The frequencies of the lightcone slices, in Hz.
+
+        sky_size : float
+            The angular size of the lightcone, in radians.
+
+        foregrounds : (ncells, ncells, nfreq)-array, optional
+            A fixed foreground lightcone (in Jy/sr) to be added to `lightcone` (to each, if a stack). Since the
+            instrument is linear in the sky, its visibilities are computed once and cached, as long as the same array
+            is passed.
+
+        rng : :class:`numpy.random.Generator`, optional
+            The Generator from which to draw the thermal noise (of all walkers at once, in turn). By default, the
+            core's own.
+
+        Returns
+        -------
+        visibilities : complex ([nwalkers,] n_baselines, n_instrumental_freq)-array
+            The visibilities, including thermal noise.
+        """
+        visibilities = self.instrument_response(lightcone, frequencies, sky_size)
+
+        if foregrounds is not None:
+            visibilities += self.foreground_visibilities(foregrounds, frequencies, sky_size)
+
+        # Just in case we forget, now the frequencies are all in terms of the instrumental frequencies.
+        frequencies = self.instrumental_frequencies
+
+        # Add thermal noise to the visibilities of all walkers at once, drawn into this thread's buffer, which is kept
+        # for its next step.
+        if self.noise_sigma is None:
+            self.noise_sigma = self.thermal_noise_sigma(
+                frequencies, self.integration_time, self.Tsys, self.effective_area, self.baseline_weights
+            )
+
+        if np.any(self.noise_sigma):
+            buffer = getattr(self._noise_buffers, "buffer", None)
+            if buffer is None or buffer.shape != visibilities.shape:
+                buffer = self._noise_buffers.buffer = np.empty(visibilities.shape, dtype=self.noise_dtype)
+
+            visibilities = self.add_thermal_noise(
+                visibilities, self.noise_sigma, rng=self.rng if rng is None else rng, out=buffer
+            )
+
+        return visibilities
+
+    def instrument_response(self, lightcone, frequencies, sky_size, cache_uv=False):
+        """
+        Pass a sky lightcone through the (noiseless) instrument: beam, FFT, baseline sampling and frequency
+        interpolation. Every step is linear in the sky.
 
-        # Add the beam attenuation
-        beam_sky = lightcone * self.beam(frequencies, sky_cells, sky_size, self.tile_diameter)
+        The lightcone is streamed through the instrument in slabs of `slab_size` frequencies: each slab is
+        beam-weighted, Fourier-transformed and sampled onto the baselines, and its contribution to each instrumental
+        frequency is accumulated. Only one slab of the lightcone is held in memory at a time.
 
-        # Fourier transform image plane to UV plane.
-        uvplane, uv = self.image_to_uv(beam_sky, sky_size)
+        A stack of lightcones (eg. one per walker) is passed through in the same calls: the walkers become a
+        trailing axis of each slab, which is transformed with it and sampled at the same (u, v) as its frequency.
+
+        Parameters
+        ----------
+        lightcone : (ncells, ncells, nfreq)- or (nwalkers, ncells, ncells, nfreq)-array
+            The sky brightness, in Jy/sr.
+
+        frequencies, sky_size :
+            See :meth:`add_instrument`.
+
+        cache_uv : bool, optional
+            Whether to keep the UV planes of the lightcone in the `disk_cache` (see :meth:`uv_plane`).
+
+        Returns
+        -------
+        visibilities : complex ([nwalkers,] n_baselines, n_instrumental_freq)-array
+            The noiseless visibilities.
+        """
+        # Number of 2D cells in sky array
+        sky_cells = np.shape(lightcone)[-2]
+        nwalkers = np.shape(lightcone)[0] if np.ndim(lightcone) == 4 else None
+        slab_size = self.slab_size or len(frequencies)
+
+        interp = self.frequency_interpolation(frequencies, self.instrumental_frequencies)
+        backend = dft.get_backend(self.fft_backend, self.fft_threads)
 
         # This is probably bad, but set baselines if none are given, to coincide exactly with the uv grid.
         if self.baselines is None:
-            self.baselines = np.zeros((len(uv[0])**2, 2))
-            U,V = np.meshgrid(uv[0], uv[1])
+            uv = np.fft.fftshift(np.fft.fftfreq(sky_cells, d=sky_size / sky_cells))
+            self.baselines = np.zeros((len(uv)**2, 2))
+            U,V = np.meshgrid(uv, uv)
             self.baselines[:, 0] = U.flatten()*(const.c/frequencies.max())
             self.baselines[:, 1] = V.flatten()*(const.c/frequencies.max())
 
-        # Fourier Transform over the (u,v) dimension and baselines sampling
-        visibilities = self.sample_onto_baselines(uvplane, uv, self.baselines, frequencies)
-        visibilities = self.interpolate_frequencies(visibilities, frequencies, self.instrumental_frequencies)
+        visibilities = None
+        for start in range(0, len(frequencies), slab_size):
+            slab = slice(start, start + slab_size)
 
-        # Just in case we forget, now the frequencies are all in terms of the instrumental frequencies.
-        frequencies = self.instrumental_frequencies
+            # Add the beam attenuation
+            beam_sky = self.apply_beam(lightcone, frequencies, sky_size, slab)
 
-        # Add thermal noise
-        visibilities = self.add_thermal_noise(visibilities, frequencies, self.integration_time, Tsys=self.Tsys)
+            # Make the walkers a trailing axis, (ncells, ncells, nslab, nwalkers).
+            if nwalkers is not None:
+                beam_sky = np.moveaxis(beam_sky, 0, -1)
 
-        return visibilities
+            if self.sampling == "nufft":
+                vis = self.sample_nufft(
+                    beam_sky, sky_size, self.baselines, frequencies[slab], eps=self.nufft_eps, backend=backend
+                )
+            else:
+                # Fourier transform image plane to UV plane. The sky is real, so only half the plane is needed.
+                if cache_uv:
+                    uvplane, uv = self.uv_plane(beam_sky, sky_size, backend=backend)
+                else:
+                    uvplane, uv = self.image_to_uv(beam_sky, sky_size, hermitian=True, backend=backend)
+
+                # Fourier Transform over the (u,v) dimension and baselines sampling.
+                operator = self.sampling_operator(uv, frequencies[slab])
+                vis = self.sample_onto_baselines(uvplane, uv, self.baselines, frequencies[slab], operator=operator)
+                del uvplane
+            del beam_sky
+
+            # Add this slab's contribution to the interpolated frequencies (of every walker at once). The slab of the
+            # operator is small, so is applied as a dense matrix.
+            contribution = np.tensordot(vis, interp[slab].toarray(), axes=(1, 0))
+            if visibilities is None:
+                visibilities = contribution
+            else:
+                visibilities += contribution
+
+        if nwalkers is not None:
+            visibilities = np.moveaxis(visibilities, 1, 0)
+
+        return visibilities.astype(np.complex64)
+
+    def foreground_visibilities(self, foregrounds, frequencies, sky_size):
+        """
+        The noiseless visibilities of a fixed foreground lightcone, computed once and cached.
+
+        The cache is keyed on the identity of the `foregrounds` array (which is expected not to change in-place),
+        and on the frequencies and sky size.
+
+        Parameters
+        ----------
+        foregrounds, frequencies, sky_size :
+            See :meth:`add_instrument`.
+
+        Returns
+        -------
+        visibilities : complex (n_baselines, n_instrumental_freq)-array
+            The noiseless visibilities of the foregrounds. Read-only.
+        """
+        return self.stages["foreground_visibilities"](
+            lightcone=foregrounds, frequencies=frequencies, sky_size=sky_size
+        )
+
+    def _foreground_response(self, lightcone, frequencies, sky_size):
+        return self.instrument_response(lightcone, frequencies, sky_size, cache_uv=True)
 
     @staticmethod
     def beam(frequencies, ncells, sky_size, D):
@@ -450,25 +1343,110 @@ class CoreInstrumental:
         sky_size : float
             The extent of the sky in radians.
 
+        D : float
+            The tile diameter, in metres (either as a plain float or a Quantity).
+
         Returns
         -------
         beam : (ncells, ncells, nfrequencies)-array
             The beam attenuation (maximum unity) over the sky.
         """
+        lm2 = _beam_lm2(ncells, float(sky_size))
+        return np.exp(-lm2[..., None] * CoreInstrumental.beam_inv_sigma2(frequencies, D))
+
+    @staticmethod
+    def beam_inv_sigma2(frequencies, D):
+        """
+        The inverse square width, 1/sigma**2, of the Gaussian beam at each frequency (see :meth:`beam`).
+
+        Parameters
+        ----------
+        frequencies : array
+            A set of frequencies (in Hz).
+
+        D : float
+            The tile diameter, in metres (either as a plain float or a Quantity).
+
+        Returns
+        -------
+        inv_sigma2 : array
+            The inverse square width of the beam, in the same shape as `frequencies`.
+        """
         # First find the sigma of the beam
         epsilon = 0.42
 
-        frequencies = frequencies / un.s
-        sigma = ((epsilon * const.c) / (frequencies * D)).to(un.dimensionless_unscaled)
+        D = _in_metres(D)
+        return (np.asarray(frequencies) * D / (epsilon * const.c.value)) ** 2
 
-        # Then create a meshgrid for the beam attenuation on sky array
-        sky_coords_lm = np.sin(np.linspace(-sky_size / 2, sky_size / 2, ncells))
-        L, M = np.meshgrid(sky_coords_lm, sky_coords_lm)
-        
-        return np.exp(np.outer(-(L ** 2 + M ** 2), 1. / sigma ** 2).reshape((ncells, ncells, len(frequencies))))
+    def beam_cube(self, frequencies, ncells, sky_size):
+        """
+        The beam at all `frequencies`, computed once and cached for as long as its inputs don't change.
+
+        Parameters
+        ----------
+        frequencies, ncells, sky_size :
+            See :meth:`beam`.
+
+        Returns
+        -------
+        beam : (ncells, ncells, nfrequencies)-array or None
+            The beam (read-only), in `beam_dtype`. If it would be larger than `beam_cache_max` bytes, it is neither
+            computed nor cached, and None is returned.
+        """
+        if ncells ** 2 * len(frequencies) * self.beam_dtype.itemsize > self.beam_cache_max:
+            return None
+
+        return self.stages["beam"](frequencies=frequencies, ncells=ncells, sky_size=sky_size)
+
+    def _beam_cube(self, frequencies, ncells, sky_size):
+        return self.beam(frequencies, ncells, sky_size, self.tile_diameter).astype(self.beam_dtype)
+
+    def apply_beam(self, lightcone, frequencies, sky_size, slab=slice(None)):
+        """
+        Attenuate a slab of a lightcone by the beam.
+
+        In "cached" `beam_mode`, the slab is multiplied by the cached beam cube (see :meth:`beam_cube`). In
+        "separable" mode (or if the beam cube is too large to cache), the beam is formed one frequency at a time, by
+        broadcasting 1/sigma**2 against a cached map of l**2 + m**2, and applied in-place to the (copied) slab.
+
+        Parameters
+        ----------
+        lightcone : (..., ncells, ncells, nfreq)-array
+            The sky brightness. Any leading axes (eg. walkers) share the same beam. It is not modified.
+
+        frequencies : (nfreq,)-array
+            The frequencies of the lightcone slices, in Hz.
+
+        sky_size : float
+            The angular size of the lightcone, in radians.
+
+        slab : slice, optional
+            The slices of the lightcone to attenuate.
+
+        Returns
+        -------
+        beam_sky : (..., ncells, ncells, nslab)-array
+            The beam-attenuated slab, in `beam_dtype`.
+        """
+        ncells = np.shape(lightcone)[-2]
+        beam_sky = np.array(lightcone[..., slab], dtype=self.beam_dtype)
+
+        cube = self.beam_cube(frequencies, ncells, sky_size) if self.beam_mode == "cached" else None
+        if cube is not None:
+            beam_sky *= cube[:, :, slab]
+            return beam_sky
+
+        lm2 = _beam_lm2(ncells, float(sky_size))
+        buffer = np.empty(lm2.shape, dtype=self.beam_dtype)
+        for i, inv_sigma2 in enumerate(self.beam_inv_sigma2(frequencies[slab], self.tile_diameter)):
+            np.multiply(lm2, -inv_sigma2, out=buffer)
+            np.exp(buffer, out=buffer)
+            beam_sky[..., i] *= buffer
+
+        return beam_sky
 
     @staticmethod
-    def image_to_uv(sky, L):
+    def image_to_uv(sky, L, hermitian=True, backend=None):
         """
         Transform a box from image plan to UV plane.
 
@@ -480,71 +1458,233 @@ class CoreInstrumental:
         L : float
             The size of the box in radians.
 
+        hermitian : bool, optional
+            Whether to use a real-to-complex transform, and return only the non-negative-u half of the UV plane.
+            The sky must then be real. The other half is given by the Hermitian symmetry
+            ``uvsky(-u, -v) = uvsky(u, v)*`` (see :meth:`sample_onto_baselines`).
+
+        backend : optional
+            The FFT backend to use (see :func:`~dft.get_backend`). Default is numpy.
+
         Returns
         -------
-        uvsky : (ncells, ncells, nfreq)-array
-            The UV-plane representation of the sky. Units are units of the sky times radians.
+        uvsky : (ncells, ncells, nfreq)- or (ncells//2 + 1, ncells, nfreq)-array
+            The UV-plane representation of the sky. Units are units of the sky times radians. If `hermitian`, only
+            the non-negative u are included.
 
         uv_scale : list of two arrays.
             The u and v co-ordinates of the uvsky, respectively. Units are inverse of L.
         """
-        ft, uv_scale = fft(sky, [L, L], axes=(0, 1))
+        if not hermitian:
+            return dft.fft(sky, [L, L], axes=(0, 1), backend=backend)
+
+        # The real transform returns only the non-negative half of the last transformed axis, which we make u.
+        ft, (v, u) = dft.rfft(sky, [L, L], axes=(1, 0), backend=backend)
+        uv_scale = [u, v]
         return ft, uv_scale
 
+    def uv_plane(self, sky, L, backend=None):
+        """
+        The half UV plane of a sky, as :meth:`image_to_uv` (with ``hermitian=True``), loaded from the `disk_cache`
+        if it has already been computed.
+
+        Entries are keyed by a hash of the contents of the sky and its size, and loaded as read-only memory maps.
+        Without a `disk_cache`, this is just :meth:`image_to_uv`.
+        """
+        if self.disk_cache is None:
+            return self.image_to_uv(sky, L, hermitian=True, backend=backend)
+
+        key = self.disk_cache.key("uv_plane", sky, float(L))
+        arrays, _ = self.disk_cache.get(key)
+        if arrays is not None:
+            return arrays["uvplane"], [arrays["u"], arrays["v"]]
+
+        uvplane, uv = self.image_to_uv(sky, L, hermitian=True, backend=backend)
+        self.disk_cache.put(key, {"uvplane": uvplane, "u": uv[0], "v": uv[1]})
+        return uvplane, uv
+
     @staticmethod
-    def sample_onto_baselines(uvplane, uv, baselines, frequencies):
+    def sample_onto_baselines(uvplane, uv, baselines, frequencies, hermitian=None, operator=None):
         """
         Sample a gridded UV sky onto a set of baselines.
 
-        Sampling is done via linear interpolation over the regular grid.
+        Sampling is done via linear interpolation over the regular grid, by applying the sparse operator of
+        :meth:`sampling_matrix` to the raveled grid. All baselines and frequencies are sampled at once, which
+        requires that the uv co-ordinates are regularly spaced (as they are from :meth:`image_to_uv`).
 
         Parameters
         ----------
-        uvplane : (ncells, ncells, nfreq)-array
-            The gridded UV sky, in Jy.
+        uvplane : (ncells, ncells, nfreq, ...)-array
+            The gridded UV sky, in Jy. Any trailing axes (eg. walkers) are sampled at the same (u, v) as their
+            frequency.
 
         uv : list of two 1D arrays
             The u and v coordinates of the uvplane respectively.
 
         baselines : (N,2)-array
-            Each row should be the (x,y) co-ordinates of a baseline, in metres.
+            Each row should be the (x,y) co-ordinates of a baseline, in metres (either as a plain array or a
+            Quantity).
 
         frequencies : 1D array
-            The frequencies of the uvplane.
+            The frequencies of the uvplane, in Hz.
+
+        hermitian : bool, optional
+            Whether `uvplane` is only the non-negative-u half of the UV plane of a real sky (as returned by
+            :meth:`image_to_uv` with ``hermitian=True``). Baselines with negative u are then folded onto the
+            half-plane, and the complex conjugate taken. The results are the same as sampling the full plane.
+            By default, this is inferred from whether the u co-ordinates start at zero.
+
+        operator : tuple, optional
+            The output of :meth:`sampling_matrix` for these arguments, if already computed.
 
         Returns
         -------
-        vis : complex (N, nfreq)-array
+        vis : complex (N, nfreq, ...)-array
              The visibilities defined at each baseline.
 
         """
-        vis = np.zeros((len(baselines), len(frequencies)), dtype=np.complex128)
+        if operator is None:
+            if hermitian is None:
+                hermitian = uv[0][0] == 0
+            operator = CoreInstrumental.sampling_matrix(uv, baselines, frequencies, hermitian)
+
+        matrix, flip = operator
+        extra = uvplane.shape[3:]
+
+        # The matrix is real, so is applied to the real and imaginary parts at once, by interleaving them.
+        flat = np.ascontiguousarray(getattr(uvplane, "value", uvplane), dtype=np.complex128)
+        flat = flat.reshape((matrix.shape[1], -1)).view(np.float64)
+        vis = np.ascontiguousarray(matrix @ flat).view(np.complex128).reshape((-1, len(frequencies)) + extra)
+
+        if flip is not None:
+            np.conjugate(vis, out=vis, where=flip.reshape(flip.shape + (1,) * len(extra)))
+
+        return vis
+
+    @staticmethod
+    def sampling_matrix(uv, baselines, frequencies, hermitian=True):
+        """
+        The sparse operator which bilinearly interpolates a gridded UV sky onto a set of baselines.
+
+        Parameters
+        ----------
+        uv, baselines, frequencies, hermitian :
+            See :meth:`sample_onto_baselines`.
+
+        Returns
+        -------
+        matrix : sparse (N * nfreq, nu * nv * nfreq)-matrix
+            The (real) interpolation operator, from the raveled (C-ordered) uvplane to the raveled visibilities. Each
+            row has the four weights of the corners of the cell in which its baseline lies.
+
+        flip : bool (N, nfreq)-array or None
+            If `hermitian`, whether each visibility has been folded onto the half-plane, and so must be conjugated
+            after applying `matrix`.
+        """
+        nfreq = len(frequencies)
+        baselines = _in_metres(baselines)
+
+        # The (u,v) of every baseline at every frequency, as plain floats of shape (N, nfreq).
+        u = np.outer(baselines[:, 0], frequencies / const.c.value)
+        v = np.outer(baselines[:, 1], frequencies / const.c.value)
+
+        ugrid, vgrid = uv
+        nu, nv = len(ugrid), len(vgrid)
+        flip = None
+
+        if hermitian:
+            # Baselines must lie within the full plane, whose u co-ordinates are the same as its v co-ordinates.
+            _check_bounds(u, vgrid)
+            _check_bounds(v, vgrid)
+
+            # Fold negative u onto the stored half-plane, using V(u, v) = V(-u, -v)*.
+            flip = u < 0
+            u = np.where(flip, -u, u)
+            v = np.where(flip, -v, v)
+
+            # Folding can take v just past the largest stored v. The DFT is periodic, so the plane there is the same
+            # as at the (stored) most negative v.
+            vgrid = np.append(vgrid, 2 * vgrid[-1] - vgrid[-2])
+
+        # Bilinear cell indices and weights for all (baseline, frequency) pairs at once.
+        iu, wu = _linear_interp_weights(u, ugrid)
+        iv, wv = _linear_interp_weights(v, vgrid)
+        iv_next = (iv + 1) % nv
+
+        # Flat index of the corners of each cell in the (C-ordered) uvplane.
+        freq_indx = np.arange(nfreq)
+        cols = np.stack([
+            (iu * nv + iv) * nfreq + freq_indx,
+            (iu * nv + iv_next) * nfreq + freq_indx,
+            ((iu + 1) * nv + iv) * nfreq + freq_indx,
+            ((iu + 1) * nv + iv_next) * nfreq + freq_indx,
+        ], axis=-1)
+        weights = np.stack([(1 - wu) * (1 - wv), (1 - wu) * wv, wu * (1 - wv), wu * wv], axis=-1)
+
+        matrix = csr_matrix(
+            (weights.ravel(), cols.ravel(), np.arange(0, weights.size + 1, 4)), shape=(u.size, nu * nv * nfreq)
+        )
+        return matrix, flip
+
+    def sampling_operator(self, uv, frequencies):
+        """
+        The operator sampling a half UV plane onto the baselines (see :meth:`sampling_matrix`), cached on the instance.
+
+        One operator is kept for each of the latest `sampling_cache_size` sets of `frequencies` (eg. slabs), for as
+        long as the baselines and UV grid are unchanged.
+        """
+        return self.stages["sampling"](frequencies=frequencies, uv=uv, baselines=self.baselines, hermitian=True)
 
-        frequencies = frequencies / un.s
+    @staticmethod
+    def sample_nufft(sky, L, baselines, frequencies, eps=1e-6, upsampfac=2.0, backend=None):
+        """
+        Evaluate the Fourier transform of a sky directly at a set of baselines, with a non-uniform FFT.
 
-        print("Sampling the data onto baselines")
+        This is the same transform as :meth:`image_to_uv` (with the same normalisation), but evaluated exactly (to
+        a relative accuracy `eps`) at each baseline, rather than on a regular grid which is then interpolated.
 
-        for i, ff in enumerate(frequencies):
-            lamb = const.c / ff.to(1 / un.s)
-            u = (baselines[:,0] / lamb).value
-            v = (baselines[:,1] / lamb).value
+        Parameters
+        ----------
+        sky : (ncells, ncells, nfreq, ...)-array
+            The (beam-attenuated) sky brightness. Any trailing axes (eg. walkers) are evaluated at the same baselines
+            as their frequency.
+
+        L : float
+            The size of the box in radians.
 
-            real = np.real(uvplane[:,:,i])
-            imag = np.imag(uvplane[:,:,i])
+        baselines : (N,2)-array
+            Each row should be the (x,y) co-ordinates of a baseline, in metres (either as a plain array or a
+            Quantity).
 
-            f_real = RegularGridInterpolator([uv[0], uv[1]], real)
-            f_imag = RegularGridInterpolator([uv[0], uv[1]], imag)
+        frequencies : 1D array
+            The frequencies of the sky, in Hz.
 
-            arr = np.zeros((len(u), 2))
-            arr[:, 0] = u
-            arr[:, 1] = v
+        eps : float, optional
+            The requested relative accuracy (see :func:`~nufft.nufft2d2`).
 
-            FT_real = f_real(arr)
-            FT_imag = f_imag(arr)
+        upsampfac : float, optional
+            The oversampling factor of the FFT grid. Smaller values mean a smaller FFT, but a wider kernel.
 
-            vis[:, i] = FT_real + FT_imag * 1j
+        backend : optional
+            The FFT backend to use (see :func:`~dft.get_backend`). Default is numpy.
 
-        return vis
+        Returns
+        -------
+        vis : complex (N, nfreq, ...)-array
+             The visibilities defined at each baseline.
+        """
+        nu, nv = sky.shape[:2]
+        baselines = _in_metres(baselines)
+
+        u = np.outer(baselines[:, 0], frequencies / const.c.value)
+        v = np.outer(baselines[:, 1], frequencies / const.c.value)
+
+        # In radians per sky cell.
+        vis = nufft.nufft2d2(
+            np.asarray(getattr(sky, "value", sky)), 2 * np.pi * u * L / nu, 2 * np.pi * v * L / nv, eps=eps,
+            upsampfac=upsampfac, backend=backend
+        )
+        return vis * (L / nu) * (L / nv)
 
     @staticmethod
     def interpolate_frequencies(visibilities, freq_grid, linear_freq):
@@ -552,6 +1692,10 @@ class CoreInstrumental:
         Interpolate a set of visibilities from a non-linear grid of frequencies onto a linear grid. Interpolation
         is linear.
 
+        The interpolation is a linear map between the two sets of frequencies (see
+        :meth:`frequency_interpolation_matrix`). The instrument applies the same map, cached on the instance (see
+        :meth:`frequency_interpolation`), to each slab of frequencies instead.
+
         Parameters
         ----------
         visibilities : complex (n_baselines, n_freq)-array
@@ -568,19 +1712,145 @@ class CoreInstrumental:
         new_vis : complex (n_baselines, N)-array
             The interpolated visibilities.
         """
-        new_vis = np.zeros((visibilities.shape[0], len(linear_freq)), dtype=np.complex64)
+        return np.asarray(
+            visibilities @ CoreInstrumental.frequency_interpolation_matrix(freq_grid, linear_freq), dtype=np.complex64
+        )
 
-        print(freq_grid/1e6)
-        print(linear_freq/1e6)
-        for i, vis in enumerate(visibilities):
-            rl = RegularGridInterpolator((freq_grid[::-1],), np.real(vis)[::-1])(linear_freq)
-            im = RegularGridInterpolator((freq_grid[::-1],), np.imag(vis)[::-1])(linear_freq)
-            new_vis[i] = rl + im * 1j
+    def frequency_interpolation(self, freq_grid, linear_freq):
+        """
+        The cached interpolation operator from `freq_grid` onto `linear_freq`.
 
-        return new_vis
+        See :meth:`frequency_interpolation_matrix`. The operator is only re-built if the frequencies change.
+        """
+        return self.stages["frequency_interpolation"](freq_grid=freq_grid, linear_freq=linear_freq)
 
     @staticmethod
-    def get_baselines(x, y):
+    def frequency_interpolation_matrix(freq_grid, linear_freq):
+        """
+        Build the sparse matrix which linearly interpolates data from one set of frequencies onto another.
+
+        Parameters
+        ----------
+        freq_grid : (nfreq)-array
+            The (monotonic, but not necessarily regular or increasing) frequencies at which data is defined.
+
+        linear_freq : (N,)-array
+            The set of frequencies on which to interpolate. Must lie within the range of `freq_grid`.
+
+        Returns
+        -------
+        matrix : sparse (nfreq, N)-matrix
+            The interpolation operator, such that ``data @ matrix`` interpolates ``(..., nfreq)`` data onto
+            `linear_freq`. Each column has at most two non-zero entries. Stored in CSR format, so that blocks of
+            rows (i.e. slabs of input frequencies) can be taken cheaply.
+        """
+        order = np.argsort(freq_grid)
+        f = np.asarray(freq_grid)[order]
+
+        if np.any(linear_freq < f[0]) or np.any(linear_freq > f[-1]):
+            raise ValueError("The instrumental frequencies must lie within the frequencies of the lightcone.")
+
+        indx = np.clip(np.searchsorted(f, linear_freq, side='right') - 1, 0, len(f) - 2)
+        weight = (linear_freq - f[indx]) / (f[indx + 1] - f[indx])
+
+        cols = np.arange(len(linear_freq))
+        return csr_matrix(
+            (np.concatenate((1 - weight, weight)),
+             (np.concatenate((order[indx], order[indx + 1])), np.concatenate((cols, cols)))),
+            shape=(len(f), len(linear_freq))
+        )
+
+    @staticmethod
+    def read_antenna_positions(fname):
+        """
+        Read an antenna position file, caching the parsed positions in a binary ``.npy`` sidecar.
+
+        The sidecar is kept in the user's cache directory (see :func:`~cache.user_directory`), under a hash of the
+        file's absolute path, and is used in place of the text file whenever it is at least as new. It is written
+        atomically, so that concurrent processes never read a partial file. If it cannot be written or read, the text
+        file is simply parsed.
+
+        Parameters
+        ----------
+        fname : str
+            Path to a whitespace-delimited text file of antenna positions.
+
+        Returns
+        -------
+        ant_pos : 2D array
+            The contents of the file.
+        """
+        directory = path.join(cache.user_directory(), "antennas")
+        sidecar = path.join(
+            directory, "%s-%s.npy" % (path.basename(fname), cache.digest(path.abspath(fname))[:16])
+        )
+
+        if path.exists(sidecar) and path.getmtime(sidecar) >= path.getmtime(fname):
+            try:
+                return np.load(sidecar)
+            except (OSError, ValueError):
+                pass
+
+        ant_pos = np.genfromtxt(fname, float)
+
+        tmp = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".npy", prefix=".tmp-", dir=directory)
+            with os.fdopen(fd, "wb") as fl:
+                np.save(fl, ant_pos)
+            os.replace(tmp, sidecar)
+        except OSError:
+            if tmp is not None and path.exists(tmp):
+                os.remove(tmp)
+
+        return ant_pos
+
+    @staticmethod
+    def iter_baselines(x, y, max_length=None, block_size=256):
+        """
+        Generate the non-autocorrelated baselines of a set of antennas, a block of antennas at a time.
+
+        Only one (block_size, n_antennas) block of separations is formed at a time, and the length cut is applied to
+        each block, so that memory scales with the number of kept baselines rather than the square of the number of
+        antennas.
+
+        Parameters
+        ----------
+        x, y : 1D arrays of the same length.
+            The positions of the arrays (presumably in metres).
+
+        max_length : float, optional
+            The maximum length of the baselines to keep, in the same units as x,y.
+
+        block_size : int, optional
+            The number of antennas in each block.
+
+        Yields
+        ------
+        baselines : (n,2)-array
+            The (x,y) co-ordinates of the baselines between each antenna in the block and all previous antennas. In
+            total, these are in the same order as :meth:`get_baselines`.
+        """
+        x = np.asarray(x)
+        y = np.asarray(y)
+
+        for start in range(0, len(x), block_size):
+            i = np.arange(start, min(start + block_size, len(x)))
+
+            # Only the antennas before the last in this block are needed, for the lower triangle.
+            xsep = x[i, None] - x[:i[-1]]
+            ysep = y[i, None] - y[:i[-1]]
+
+            # Take the lower triangle, and remove autocorrelations and long baselines.
+            keep = (np.arange(i[-1]) < i[:, None]) & ((xsep != 0) | (ysep != 0))
+            if max_length is not None:
+                keep &= xsep ** 2 + ysep ** 2 <= max_length ** 2
+
+            yield np.array([xsep[keep], ysep[keep]]).T
+
+    @staticmethod
+    def get_baselines(x, y, max_length=None, block_size=256):
         """
         From a set of antenna positions, determine the non-autocorrelated baselines.
 
@@ -589,47 +1859,181 @@ class CoreInstrumental:
         x, y : 1D arrays of the same length.
             The positions of the arrays (presumably in metres).
 
+        max_length : float, optional
+            The maximum length of the baselines to keep, in the same units as x,y.
+
+        block_size : int, optional
+            The number of antennas processed at a time (see :meth:`iter_baselines`).
+
         Returns
         -------
         baselines : (n_baselines,2)-array
             Each row is the (x,y) co-ordinate of a baseline, in the same units as x,y.
         """
-        # ignore up.
-        ind = np.tril_indices(len(x), k=-1)
-        Xsep = np.add.outer(x, -x)[ind]
-        Ysep = np.add.outer(y, -y)[ind]
+        return np.concatenate(
+            [np.zeros((0, 2))] + list(CoreInstrumental.iter_baselines(x, y, max_length, block_size))
+        )
 
-        # Remove autocorrelations
-        zeros = np.logical_and(Xsep.flatten()==0, Ysep.flatten()==0)
+    @staticmethod
+    def group_redundant_baselines(baselines, tol):
+        """
+        Group baselines which are redundant to within a tolerance.
 
-        return np.array([Xsep.flatten()[np.logical_not(zeros)], Ysep.flatten()[np.logical_not(zeros)]]).T
+        Baselines are grouped if they fall in the same cell of a grid with spacing `tol` (so that baselines closer
+        than `tol` are usually, but not always, grouped together).
+
+        Parameters
+        ----------
+        baselines : (n_baselines, 2)-array
+            The baselines, in metres.
+
+        tol : float
+            The tolerance, in metres.
+
+        Returns
+        -------
+        baselines : (n_groups, 2)-array
+            The mean baseline of each redundant group.
+
+        multiplicity : (n_groups,)-array
+            The number of baselines in each group.
+        """
+        baselines = np.asarray(baselines, dtype=float)
+
+        keys = np.round(baselines / tol).astype(np.int64)
+        _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+
+        centres = np.array([np.bincount(inverse, weights=baselines[:, i]) for i in range(2)]).T / counts[:, None]
+
+        return centres, counts.astype(float)
+
+    @staticmethod
+    def thermal_noise_sigma(frequencies, integration_time, Tsys, effective_area=20.0, baseline_weights=None):
+        """
+        The rms thermal noise of each visibility, from the radiometer equation.
+
+        Each of the real and imaginary parts of a visibility has an rms of
+        ``sqrt(2) k_B Tsys / (A_eff sqrt(dnu t))`` (ie. SEFD / sqrt(2 dnu t)), where `dnu` is the channel width.
+
+        Parameters
+        ----------
+        frequencies : (nfreq,)-array
+            The (regularly spaced) instrumental frequencies, in Hz.
+
+        integration_time : float
+            The integration time, in seconds.
+
+        Tsys : float or (nfreq,)-array
+            The system temperature, in K.
+
+        effective_area : float, optional
+            The effective area of a tile, in m^2.
+
+        baseline_weights : (n_baselines,)-array, optional
+            The number of redundant baselines averaged into each visibility, which reduces its noise.
+
+        Returns
+        -------
+        sigma : (1 or n_baselines, nfreq)-array
+            The rms of each of the real and imaginary parts of each visibility, in Jy.
+        """
+        frequencies = np.asarray(frequencies, dtype=float)
+        channel_width = np.abs(frequencies[1] - frequencies[0]) if len(frequencies) > 1 else 1.0
+
+        sefd = 2 * const.k_B.value * np.asarray(Tsys, dtype=float) / effective_area * 1e26
+        sigma = np.broadcast_to(sefd / np.sqrt(2 * channel_width * integration_time), frequencies.shape)[None, :]
+
+        if baseline_weights is not None:
+            sigma = sigma / np.sqrt(np.asarray(baseline_weights, dtype=float))[:, None]
+
+        return np.array(sigma)
 
     @staticmethod
-    def add_thermal_noise(visibilities, frequencies, delta_t = 1200, Tsys=0):
+    def add_thermal_noise(visibilities, sigma, rng=None, out=None):
         """
         Add thermal noise to each visibility.
 
+        The noise of all visibilities is drawn in a single call.
+
         Parameters
         ----------
-        visibilities : (n_baseline, n_freq)-array
-            The visibilities at each baseline and frequency.
+        visibilities : complex ([nwalkers,] n_baseline, n_freq)-array
+            The visibilities at each baseline and frequency. Modified in place.
+
+        sigma : array
+            The rms of each of the real and imaginary parts of the noise, broadcastable against `visibilities` (see
+            :meth:`thermal_noise_sigma`).
 
-        frequencies : (n_freq)-array
-            The frequencies of the observation.
+        rng : :class:`numpy.random.Generator`, optional
+            The source of random numbers. By default, numpy's global random state.
 
-        delta_t : float, optional
-            The integration time
+        out : complex array, optional
+            A buffer of the shape of `visibilities` into which to draw the noise, of complex64 or complex128 precision.
+            By default, a complex128 buffer is allocated.
 
         Returns
         -------
+        visibilities : complex array
+            The noisy visibilities.
+        """
+        if out is None:
+            out = np.empty(np.shape(visibilities), dtype=np.complex128)
+
+        # The real and imaginary parts, as one real array.
+        parts = out.view(out.real.dtype)
+
+        if isinstance(rng, np.random.Generator):
+            rng.standard_normal(out=parts, dtype=parts.dtype)
+        else:
+            rng = np.random if rng is None else rng
+            parts[...] = rng.standard_normal(parts.shape)
+
+        out *= sigma
+        visibilities += out
 
+        return visibilities
+
+
+class CoreSharedMemory:
+    def __init__(self, pool=None, keys=("visibilities", "baselines", "baseline_weights", "frequencies"),
+                 lightcone=True, keep=2):
         """
-        sigma = Tsys / np.sqrt((frequencies.max()-frequencies.min())*delta_t)
-        
-        rl = np.random.normal(np.mean(np.real(visibilities)), np.std(np.real(visibilities)))
-        im = np.random.normal(np.mean(np.imag(visibilities)), np.std(np.imag(visibilities)))
-        
-        # TODO: check the units of sigma 
-        visibilities += sigma * (rl + im * 1j)
-        
-        return visibilities
\ No newline at end of file
+        Core MCMC class which moves the large arrays of the context into shared memory, so that the context is
+        pickled (eg. out of the workers of a process pool) as lightweight handles rather than copies.
+
+        Should be loaded after the cores which add the arrays (eg. :class:`CoreInstrumental`). Each step is shared in
+        new memory, which is released `keep` steps later (see :meth:`~shared.SharedMemoryPool.share_context`), or by
+        :meth:`close`.
+
+        Parameters
+        ----------
+        pool : :class:`~shared.SharedMemoryPool`, optional
+            The pool which owns the shared memory. By default, each process makes its own in :meth:`setup`.
+
+        keys : tuple of str, optional
+            The keys of the arrays in the context to share.
+
+        lightcone : bool, optional
+            Whether to also share the ``lightcone_box`` of the "output" lightcone.
+
+        keep : int, optional
+            The number of steps whose shared memory is kept, ie. which may still be in flight at once.
+        """
+        self.pool = pool
+        self.keys = keys
+        self.lightcone = lightcone
+        self.keep = keep
+
+    def setup(self):
+        if self.pool is None:
+            self.pool = shared.SharedMemoryPool()
+
+    def __call__(self, ctx):
+        self.pool.share_context(ctx, self.keys, lightcone=self.lightcone, keep=self.keep)
+
+    def close(self):
+        """
+        Release the shared memory of the pool.
+        """
+        self.pool.close()
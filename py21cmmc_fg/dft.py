@@ -0,0 +1,214 @@
+"""
+Fourier transforms with a selectable backend.
+
+The spatial FFT in :class:`~core.CoreInstrumental` and the frequency FFT in :class:`~likelihood.LikelihoodForeground2D`
+are performed on arrays of the same shape at every step of a chain. This module lets them use either numpy,
+``scipy.fft`` (with multiple workers) or pyFFTW (with cached plans and aligned buffers for each shape), through a
+common interface. The :func:`fft` and :func:`rfft` functions follow the conventions of :func:`powerbox.dft.fft` with
+its default Fourier convention (``a=0, b=2pi``).
+"""
+from collections import OrderedDict
+from functools import lru_cache
+import os
+import threading
+
+import numpy as np
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+
+class NumpyFFT:
+    """
+    FFT backend using :mod:`numpy.fft`. Single-threaded.
+    """
+    name = "numpy"
+
+    def __init__(self, nthreads=1):
+        self.nthreads = 1
+
+    def fftn(self, x, axes):
+        return np.fft.fftn(x, axes=axes)
+
+    def rfftn(self, x, axes):
+        return np.fft.rfftn(x, axes=axes)
+
+
+class ScipyFFT(NumpyFFT):
+    """
+    FFT backend using :mod:`scipy.fft`, parallelised over `nthreads` workers.
+    """
+    name = "scipy"
+
+    def __init__(self, nthreads=1):
+        if scipy_fft is None:
+            raise ImportError("scipy.fft is required for the 'scipy' FFT backend.")
+        self.nthreads = nthreads
+
+    def fftn(self, x, axes):
+        return scipy_fft.fftn(x, axes=axes, workers=self.nthreads)
+
+    def rfftn(self, x, axes):
+        return scipy_fft.rfftn(x, axes=axes, workers=self.nthreads)
+
+
+class FFTWFFT(NumpyFFT):
+    """
+    FFT backend using pyFFTW, with `nthreads` threads.
+
+    A plan (with its own aligned input and output buffers) is made the first time each combination of transform,
+    shape, dtype and axes is seen in a thread, and re-used thereafter. Each thread has its own plans (at most
+    `max_plans` of them), since the backend instance is shared (see :func:`get_backend`) and a plan's buffers can
+    only be used by one transform at a time. The result is copied out of the plan's output buffer, so it is owned
+    by the caller.
+    """
+    name = "pyfftw"
+
+    def __init__(self, nthreads=1, planner_effort="FFTW_MEASURE", max_plans=8):
+        if pyfftw is None:
+            raise ImportError("pyfftw is required for the 'pyfftw' FFT backend.")
+        self.nthreads = nthreads
+        self.planner_effort = planner_effort
+        self.max_plans = max_plans
+        self._local = threading.local()
+
+    @property
+    def _plans(self):
+        # The plans of the calling thread.
+        plans = getattr(self._local, "plans", None)
+        if plans is None:
+            plans = self._local.plans = OrderedDict()
+        return plans
+
+    def _plan(self, builder, x, axes):
+        key = (builder.__name__, x.shape, x.dtype.str, tuple(axes))
+
+        plans = self._plans
+        if key in plans:
+            plans.move_to_end(key)
+        else:
+            # Plan on an empty aligned array, as planning may overwrite its input.
+            plans[key] = builder(
+                pyfftw.empty_aligned(x.shape, dtype=x.dtype), axes=axes, threads=self.nthreads,
+                planner_effort=self.planner_effort
+            )
+            if len(plans) > self.max_plans:
+                plans.popitem(last=False)
+
+        return plans[key]
+
+    def fftn(self, x, axes):
+        return self._plan(pyfftw.builders.fftn, x, axes)(x).copy()
+
+    def rfftn(self, x, axes):
+        return self._plan(pyfftw.builders.rfftn, x, axes)(x).copy()
+
+
+BACKENDS = {b.name: b for b in (NumpyFFT, ScipyFFT, FFTWFFT)}
+
+
+@lru_cache(maxsize=None)
+def get_backend(name="numpy", nthreads=1):
+    """
+    Get a (shared) FFT backend instance.
+
+    Parameters
+    ----------
+    name : {"numpy", "scipy", "pyfftw"}, optional
+        The backend to use.
+
+    nthreads : int, optional
+        The number of threads to use, if the backend supports it. If None or 0, use all available CPUs.
+
+    Returns
+    -------
+    backend :
+        An object with ``fftn(x, axes)`` and ``rfftn(x, axes)`` methods.
+    """
+    if name not in BACKENDS:
+        raise ValueError("FFT backend must be one of %s, got '%s'" % (list(BACKENDS), name))
+
+    return BACKENDS[name](nthreads=nthreads or os.cpu_count())
+
+
+def _lengths(L, N):
+    if np.isscalar(L) or np.ndim(L) == 0:
+        return [float(L)] * len(N)
+    return [float(l) for l in L]
+
+
+def fft(X, L, axes, backend=None):
+    """
+    The Fourier transform of `X` over `axes`, normalised to approximate the continuous transform.
+
+    Equivalent to :func:`powerbox.dft.fft` with ``a=0, b=2pi``: the result is multiplied by the cell volume, and is
+    centred with monotonically increasing frequencies.
+
+    Parameters
+    ----------
+    X : array
+        The field to transform.
+
+    L : float or list of floats
+        The length of the box in each transformed dimension.
+
+    axes : tuple of int
+        The axes to transform.
+
+    backend : optional
+        The FFT backend (see :func:`get_backend`). Default is numpy.
+
+    Returns
+    -------
+    ft : complex array
+        The transformed field.
+
+    freq : list of arrays
+        The frequencies of each transformed axis.
+    """
+    backend = backend or get_backend()
+    N = [X.shape[axis] for axis in axes]
+    L = _lengths(L, N)
+
+    ft = np.fft.fftshift(backend.fftn(X, axes=axes), axes=axes)
+    ft *= np.prod([l / n for l, n in zip(L, N)])
+
+    freq = [np.fft.fftshift(np.fft.fftfreq(n, d=l / n)) for l, n in zip(L, N)]
+    return ft, freq
+
+
+def rfft(X, L, axes, backend=None):
+    """
+    As :func:`fft`, but for a real `X`, returning only the non-negative frequencies of the last axis in `axes`.
+
+    Parameters
+    ----------
+    X, L, axes, backend :
+        See :func:`fft`.
+
+    Returns
+    -------
+    ft : complex array
+        The transformed field. All transformed axes but the last are centred, while the last contains only
+        non-negative frequencies.
+
+    freq : list of arrays
+        The frequencies of each transformed axis (in the order of `axes`).
+    """
+    backend = backend or get_backend()
+    N = [X.shape[axis] for axis in axes]
+    L = _lengths(L, N)
+
+    ft = np.fft.fftshift(backend.rfftn(X, axes=axes), axes=axes[:-1])
+    ft *= np.prod([l / n for l, n in zip(L, N)])
+
+    freq = [np.fft.fftshift(np.fft.fftfreq(n, d=l / n)) for l, n in zip(L[:-1], N[:-1])]
+    freq.append(np.fft.rfftfreq(N[-1], d=L[-1] / N[-1]))
+    return ft, freq
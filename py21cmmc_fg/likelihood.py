@@ -6,21 +6,22 @@ Created on Fri Apr 20 16:54:22 2018
 @author: bella
 """
 
-from powerbox.dft import fft
-from powerbox.tools import angular_average_nd
+import os
+from multiprocessing import Pool
+
 import numpy as np
 from astropy import constants as const
-from astropy.cosmology import Planck15 as cosmo
-from astropy import units as un
 
 from py21cmmc.likelihood import LikelihoodBase, Core21cmFastModule
 from cosmoHammer.ChainContext import ChainContext
 from cosmoHammer.util import Params
-from .core import CoreForegrounds
+from . import conversions, dft, stages
+from .core import CoreForegrounds, _in_metres
 
 
 class LikelihoodForeground2D(LikelihoodBase):
-    def __init__(self, datafile, n_uv=None, n_psbins=50, umax = None,**kwargs):
+    def __init__(self, datafile, n_uv=None, n_psbins=50, umax = None, fft_backend="numpy", fft_threads=1,
+                 subtract_noise_bias=False, **kwargs):
         """
         A likelihood for EoR physical parameters, based on a Gaussian 2D power spectrum.
 
@@ -48,6 +49,17 @@ class LikelihoodForeground2D(LikelihoodBase):
 
         umax : float, optional
             The extent of the UV grid. By default, uses the longest baseline at the highest frequency.
+
+        fft_backend : {"numpy", "scipy", "pyfftw"}, optional
+            The library used for the frequency FFT (see :func:`~dft.get_backend`).
+
+        fft_threads : int, optional
+            The number of threads used by the FFT backend (if it supports more than one). If None, use all CPUs.
+
+        subtract_noise_bias : bool, optional
+            Whether to subtract the expected power of the thermal noise (see :meth:`noise_bias`) from the model power
+            spectrum. It is computed analytically from the rms noise of the visibilities (the "noise_sigma" of the
+            context), once for a given instrument.
         """
 
         super().__init__(**kwargs)
@@ -55,6 +67,20 @@ class LikelihoodForeground2D(LikelihoodBase):
         self.n_uv = n_uv
         self.n_psbins = n_psbins
         self.umax = umax
+        self.fft_backend = fft_backend
+        self.fft_threads = fft_threads
+        self.subtract_noise_bias = subtract_noise_bias
+
+        # Cached stages: the assignment of baselines to UV cells, which is fixed as long as the baselines are, the
+        # radial bin of each cell in the power spectrum grid, and the power spectrum of the thermal noise.
+        self.stages = stages.StageGraph()
+        self.stages.add(
+            "grid_indices", self.grid_indices, ("baselines", "frequencies", "ngrid", "umax", "baseline_weights")
+        )
+        self.stages.add("bin_indices", self._bin_indices, ("coords", "weights", "bins", "spherical"))
+        self.stages.add(
+            "noise_bias", self.noise_bias, ("sigma", "baselines", "frequencies", "n_uv", "baseline_weights")
+        )
 
     def setup(self):
         """
@@ -73,10 +99,98 @@ class LikelihoodForeground2D(LikelihoodBase):
         # This just monitors whether we've check the k dimensions.
         self._checked = False
 
+    def share(self, pool):
+        """
+        Move the read-only data (kpar, kperp, power and its uncertainty) into shared memory, so that the likelihood
+        is pickled (eg. into the workers of a process pool) with lightweight handles to them.
+
+        Call after :meth:`setup`.
+
+        Parameters
+        ----------
+        pool : :class:`~shared.SharedMemoryPool`
+            The pool which owns the shared memory.
+        """
+        for name in ("kpar", "kperp", "power", "uncertainty"):
+            if getattr(self, name, None) is not None:
+                setattr(self, name, pool.share(getattr(self, name)))
+
     def computeLikelihood(self, ctx):
 
         p, k = self.computePower(ctx)
+        return self.likelihood_from_power(p, k)
+
+    def computeLikelihoodBatch(self, lightcones, redshifts, boxsize, fg_core, instr_core):
+        """
+        Compute the likelihood of a stack of EoR lightcones (eg. one per walker) at once.
 
+        This is the batched equivalent of running `fg_core`, `instr_core` and :meth:`computeLikelihood` on each
+        lightcone's context in turn. The beam, FFTs, baseline sampling, frequency interpolation, gridding and
+        power-spectrum binning are each done in a single vectorised call over the whole stack, re-using the same
+        cached operators.
+
+        Parameters
+        ----------
+        lightcones : (nwalkers, ncells, ncells, nslices)-array
+            The EoR lightcones, in mK. They may be modified in-place (see
+            :meth:`~core.CoreForegrounds.add_foregrounds_batch`).
+
+        redshifts : (nslices,)-array
+            The redshifts of the lightcone slices.
+
+        boxsize : float
+            The transverse size of the lightcones, in Mpc.
+
+        fg_core : :class:`~core.CoreForegrounds` instance or None
+            The foregrounds to add to each lightcone. If None, the lightcones are used as they are (in Jy/sr).
+
+        instr_core : :class:`~core.CoreInstrumental` instance
+
+        Returns
+        -------
+        lnl : (nwalkers,)-array
+            The log-likelihood of each lightcone.
+        """
+        if fg_core is None:
+            frequencies = conversions.F21 / (1 + np.asarray(redshifts))
+            sky_size = CoreForegrounds.get_sky_size(boxsize, redshifts)
+            foregrounds = None
+        else:
+            lightcones, frequencies, sky_size, foregrounds = fg_core.add_foregrounds_batch(
+                lightcones, redshifts, boxsize
+            )
+
+        visibilities = instr_core.add_instrument(lightcones, frequencies, sky_size, foregrounds=foregrounds)
+
+        n_uv = self.n_uv or lightcones.shape[1]
+        p, k = self.power_spectrum(
+            visibilities, instr_core.baselines, instr_core.instrumental_frequencies, n_uv,
+            baseline_weights=instr_core.baseline_weights
+        )
+        p = self._debias(
+            p, instr_core.noise_sigma, instr_core.baselines, instr_core.instrumental_frequencies, n_uv,
+            instr_core.baseline_weights
+        )
+        return self.likelihood_from_power(p, k)
+
+    def likelihood_from_power(self, p, k):
+        """
+        The log-likelihood of a model power spectrum (or of each in a stack of them).
+
+        Parameters
+        ----------
+        p : array
+            The model power spectrum, as returned by :meth:`computePower`, with any number of leading (eg. walker)
+            axes.
+
+        k : list of arrays
+            The co-ordinates of the power spectrum.
+
+        Returns
+        -------
+        lnl : float or array
+            The log-likelihood, of the same shape as the leading axes of `p`.
+        """
         # Make sure we have the correct kpar and kperp. We can remove this if the data itself is generated from
         # this class.
         if not self._checked:
@@ -91,7 +205,7 @@ class LikelihoodForeground2D(LikelihoodBase):
 
         # FIND CHI SQUARE OF PS!!!
         # TODO: this is a bit too simple. We need uncertainties!
-        return -0.5 * np.sum((self.power - p) ** 2 / self.uncertainty ** 2)
+        return -0.5 * np.sum((self.power - p) ** 2 / self.uncertainty ** 2, axis=tuple(range(-np.ndim(self.power), 0)))
 
     def computePower(self, ctx):
         """
@@ -106,7 +220,7 @@ class LikelihoodForeground2D(LikelihoodBase):
         Returns
         -------
         power2d : (nperp, npar)-array
-            The 2D power spectrum.
+            The 2D power spectrum, less the thermal noise bias if `subtract_noise_bias` is set.
 
         coords : list of 2 arrays
             The first is kperp, and the second is kpar.
@@ -115,11 +229,135 @@ class LikelihoodForeground2D(LikelihoodBase):
         visibilities = ctx.get("visibilities")
         baselines = ctx.get('baselines')
         frequencies = ctx.get("frequencies")
+        baseline_weights = ctx.get("baseline_weights", None)
         n_uv = self.n_uv or ctx.get("output").lightcone_box.shape[0]
 
-        # Compute 2D power.
-        ugrid, visgrid, weights = self.grid(visibilities, baselines, frequencies, n_uv, self.umax)
-        visgrid, eta = self.frequency_fft(visgrid, frequencies)
+        p, k = self.power_spectrum(visibilities, baselines, frequencies, n_uv, baseline_weights=baseline_weights)
+        p = self._debias(p, ctx.get("noise_sigma", None), baselines, frequencies, n_uv, baseline_weights)
+
+        return p, k
+
+    def _debias(self, p, sigma, baselines, frequencies, n_uv, baseline_weights):
+        # Subtract the (cached) noise bias from a power spectrum, if asked to and the noise is known.
+        if not self.subtract_noise_bias or sigma is None:
+            return p
+
+        bias, _ = self.stages["noise_bias"](
+            sigma=sigma, baselines=baselines, frequencies=frequencies, n_uv=n_uv, baseline_weights=baseline_weights
+        )
+        return p - bias
+
+    def noise_variance(self, sigma, baselines, frequencies, n_uv, umax=None, baseline_weights=None):
+        """
+        The variance of the thermal noise in each cell of the gridded, frequency-transformed visibilities.
+
+        The noise of each visibility is independent, so its variance is propagated through the (linear) gridding
+        and frequency FFT directly: the variance of a cell is the sum of those of its baselines, with the squares of
+        their gridding weights, and that of each eta is the sum over frequencies, with the squared modulus of the
+        Fourier kernel.
+
+        Parameters
+        ----------
+        sigma : (1 or n_baselines, n_freq)-array
+            The rms of each of the real and imaginary parts of the noise of each visibility (see
+            :meth:`~core.CoreInstrumental.thermal_noise_sigma`).
+
+        baselines, frequencies, umax, baseline_weights :
+            See :meth:`grid`.
+
+        n_uv : int
+            The number of UV cells to grid the visibilities (per side).
+
+        Returns
+        -------
+        centres : (n_uv,)-array
+            The co-ordinates of the grid cells, in UV.
+
+        variance : (n_uv, n_uv, neta)-array
+            The expected ``|noise|**2`` of each cell.
+
+        eta : (neta,)-array
+            The eta-coordinates.
+
+        weights : (n_uv, n_uv, n_freq)-array
+            The weights of the grid.
+        """
+        nbl = len(baselines)
+        variance = 2 * np.broadcast_to(np.asarray(sigma, dtype=float) ** 2, (nbl, len(frequencies)))
+        if baseline_weights is not None:
+            variance = variance * np.asarray(baseline_weights)[:, None]
+
+        # Gridding divides the weighted sum of the visibilities by the weight of the cell, and so divides the
+        # variance by its square.
+        centres, variance, weights = self.grid_visibilities(
+            variance, baselines, frequencies, n_uv, umax, baseline_weights=baseline_weights
+        )
+        variance = variance.real
+        mask = weights > 0
+        variance[mask] /= weights[mask]
+
+        # The Fourier kernel of the frequency FFT, as the transform of each frequency channel.
+        kernel, eta = self.frequency_fft(np.eye(len(frequencies)), frequencies)
+
+        return centres, variance @ np.abs(kernel) ** 2, eta, weights
+
+    def noise_bias(self, sigma, baselines, frequencies, n_uv, baseline_weights=None):
+        """
+        The expected 2D power spectrum of the thermal noise alone, which biases that of noisy visibilities.
+
+        It is computed analytically (see :meth:`noise_variance`), without drawing any noise realisations.
+
+        Parameters
+        ----------
+        sigma : (1 or n_baselines, n_freq)-array
+            The rms of each of the real and imaginary parts of the noise of each visibility.
+
+        baselines, frequencies, n_uv, baseline_weights :
+            See :meth:`power_spectrum`.
+
+        Returns
+        -------
+        power2d : (nperp, npar)-array
+            The 2D power spectrum of the noise.
+
+        coords : list of 2 arrays
+            The first is kperp, and the second is kpar.
+        """
+        ugrid, variance, eta, weights = self.noise_variance(
+            sigma, baselines, frequencies, n_uv, self.umax, baseline_weights=baseline_weights
+        )
+        return self.get_2d_power(
+            np.sqrt(variance), [ugrid, ugrid, eta], weights, frequencies.min(), frequencies.max(), bins=self.n_psbins
+        )
+
+    def power_spectrum(self, visibilities, baselines, frequencies, n_uv, baseline_weights=None):
+        """
+        Compute the 2D power spectrum of a set of visibilities (or of each in a stack of them).
+
+        Parameters
+        ----------
+        visibilities : complex (..., n_baselines, n_freq)-array
+            The visibilities. Any leading axes (eg. walkers) are treated independently, but in the same vectorised
+            calls.
+
+        baselines, frequencies, baseline_weights :
+            See :meth:`grid`.
+
+        n_uv : int
+            The number of UV cells to grid the visibilities (per side).
+
+        Returns
+        -------
+        power2d : (..., nperp, npar)-array
+            The 2D power spectrum.
+
+        coords : list of 2 arrays
+            The first is kperp, and the second is kpar.
+        """
+        ugrid, visgrid, weights = self.grid_visibilities(
+            visibilities, baselines, frequencies, n_uv, self.umax, baseline_weights=baseline_weights
+        )
+        visgrid, eta = self.frequency_fft(visgrid, frequencies, dft.get_backend(self.fft_backend, self.fft_threads))
         power2d, coords = self.get_2d_power(visgrid, [ugrid, ugrid, eta], weights, frequencies.min(), frequencies.max(), bins=self.n_psbins)
 
         return power2d, coords
@@ -131,7 +369,7 @@ class LikelihoodForeground2D(LikelihoodBase):
         Parameters
         ----------
 
-        fourier_vis : complex (ngrid, ngrid, neta)-array
+        fourier_vis : complex (..., ngrid, ngrid, neta)-array
             The gridded visibilities, fourier-transformed along the frequency axis. Units JyHz.
 
         coords: list of 3 1D arrays.
@@ -150,46 +388,152 @@ class LikelihoodForeground2D(LikelihoodBase):
 
         Returns
         -------
-        P : float (n_eta, bins)-array
+        P : float (..., n_eta, bins)-array
             The cylindrical averaged (or 2D) Power Spectrum, with units Mpc**3.
 
         coords : list of 2 1D arrays
             The first value is the coordinates of k_perp (in 1/Mpc), and the second is k_par (in 1/Mpc).
         """
-        # Change the units of coords to Mpc
+        # Change the units of coords to Mpc. Note that we don't modify coords in-place, as the grid co-ordinates
+        # are cached and shared between calls.
         z_mid = 1420e6 / (nu_min+nu_max)/2 - 1
-        coords[0] *= 2 * np.pi / cosmo.comoving_transverse_distance([z_mid])
-        coords[1] *= 2 * np.pi / cosmo.comoving_transverse_distance([z_mid])
-        coords[2] = 2 * np.pi * coords[2] * cosmo.H0.to(un.m / (un.Mpc * un.s)) * 1420e6 * un.Hz * cosmo.efunc(
-            z_mid) / (const.c * (1 + z_mid) ** 2)
+        kperp = 2 * np.pi * coords[0] / conversions.comoving_transverse_distance(z_mid)
+        kperp_y = 2 * np.pi * coords[1] / conversions.comoving_transverse_distance(z_mid)
+        kpar = coords[2] * conversions.eta_to_kpar(z_mid)
 
         # The 3D power spectrum
         power_3d = np.absolute(fourier_vis) ** 2
 
-        # Generate the radial bins and coords
-        radial_bins = np.linspace(0, np.sqrt(2 * np.max(coords[0].value) ** 2), bins+1)
-        u, v = np.meshgrid(coords[0], coords[1])
-
-        # Initialize the power and 2d weights.
-        P = np.zeros([fourier_vis.shape[-1], len(radial_bins)])
-        bins = np.zeros_like(P)
-
-        # Determine which radial bin each cell lies in.
-        bin_indx = np.digitize((u.value ** 2 + v.value ** 2), bins=radial_bins ** 2) - 1
-
-        print(bin_indx.shape)
         # Average within radial bins, weighting with weights.
-        for i in range(len(coords[2])):
-            P[i, :] = np.bincount(bin_indx.flatten(), weights=(weights[:, :, i]*power_3d[:, :, i]).flatten())
-            bins[i, :] = np.bincount(bin_indx.flatten(), weights=weights[:, :, i].flatten())
-        P[bins > 0] = P[bins > 0] / bins[bins > 0]
+        P, kperp_centres = self.bin_power(power_3d, [kperp, kperp_y, kpar], weights, bins)
 
         # Convert the units of the power into Mpc**6
-        P /= ((CoreForegrounds.conversion_factor_K_to_Jy() * self.hz_to_mpc(nu_min, nu_max) * self.sr_to_mpc2(z_mid)) ** 2).value
+        P /= (conversions.K_to_Jy() * self.hz_to_mpc(nu_min, nu_max) * self.sr_to_mpc2(z_mid)) ** 2
         P /= self.volume(z_mid, nu_min, nu_max)
 
         # TODO: In here we also need to calculate the VARIANCE of the power!!
-        return P, [(radial_bins[1:]+radial_bins[:-1])/2, coords[2].value]
+        return P, [kperp_centres, kpar]
+
+    def bin_power(self, power, coords, weights, bins, spherical=False):
+        """
+        Take the weighted average of a power spectrum cube within radial bins.
+
+        This is the binning engine for both the 2D (cylindrical) and 1D (spherical) power spectra. The bin in which
+        each cell lies, and the total weight in each bin, are fixed for a given grid and set of weights, so they are
+        determined once (see :meth:`radial_bin_indices`) and cached on the instance. Every call then only needs
+        a single weighted ``np.bincount`` over the cube (or over a whole stack of cubes).
+
+        Parameters
+        ----------
+        power : (..., ngrid, ngrid, neta)-array
+            The power in each cell of the grid. Any leading axes are binned independently.
+
+        coords : list of 3 1D arrays
+            The [kx, ky, kpar] co-ordinates of the grid.
+
+        weights : (ngrid, ngrid)- or (ngrid, ngrid, >=neta)-array
+            The relative weight of each grid point. If 2D, the same weights are used for every kpar (without
+            repeating them along that axis). If 3D, only the first `neta` slices are used.
+
+        bins : int
+            The number of radial bins.
+
+        spherical : bool, optional
+            Whether to average in spherical shells of |k| (a 1D power spectrum), rather than in annuli of kperp
+            (a 2D power spectrum).
+
+        Returns
+        -------
+        P : array
+            If `spherical`, a (..., bins)-array of the averaged power. Otherwise, a (..., neta, bins+1)-array of the
+            power averaged in kperp bins at each kpar.
+
+        k : (bins,)-array
+            If `spherical`, the weighted mean |k| of each bin. Otherwise, the centre of each kperp bin.
+        """
+        if weights.ndim == 3:
+            weights = weights[:, :, :power.shape[-1]]
+
+        indx, sumweights, kbins = self.radial_bin_indices(coords, weights, bins, spherical)
+
+        # Each cube in the stack gets its own set of bins in the flat output.
+        batch = power.shape[:-3]
+        nbatch = int(np.prod(batch))
+        nbins = len(sumweights)
+
+        P = np.bincount(
+            (indx.ravel() + nbins * np.arange(nbatch)[:, None]).ravel(),
+            weights=(power * (weights if weights.ndim == 3 else weights[:, :, None])).ravel(),
+            minlength=nbins * nbatch
+        ).reshape(batch + (nbins,))
+
+        mask = sumweights > 0
+        P[..., mask] /= sumweights[mask]
+
+        if spherical:
+            return P[..., 1:-1], kbins
+        else:
+            return P.reshape(batch + (power.shape[-1], -1)), kbins
+
+    def radial_bin_indices(self, coords, weights, bins, spherical=False):
+        """
+        Determine which radial bin each cell of a (kx, ky, kpar) grid lies in, and the total weight of each bin.
+
+        The result is cached on the instance (as the "bin_indices" stage), and is only re-computed if the
+        co-ordinates, weights or bins change.
+
+        Parameters
+        ----------
+        coords : list of 3 1D arrays
+            The [kx, ky, kpar] co-ordinates of the grid.
+
+        weights : (ngrid, ngrid)- or (ngrid, ngrid, neta)-array
+            The relative weight of each grid point.
+
+        bins : int
+            The number of radial bins.
+
+        spherical : bool, optional
+            Whether to bin in spherical |k|, rather than in kperp.
+
+        Returns
+        -------
+        indx : int (ngrid, ngrid, neta)-array
+            The flat index of each cell into the raveled output of :meth:`bin_power`.
+
+        sumweights : 1D array
+            The total weight in each flat output bin.
+
+        k : (bins,)-array
+            The co-ordinates of the bins (see :meth:`bin_power`).
+        """
+        return self.stages["bin_indices"](coords=coords, weights=weights, bins=bins, spherical=spherical)
+
+    @staticmethod
+    def _bin_indices(coords, weights, bins, spherical):
+        shape = (len(coords[1]), len(coords[0]), len(coords[2]))
+        w = np.broadcast_to(weights if weights.ndim == 3 else weights[:, :, None], shape)
+
+        if spherical:
+            # Same conventions as powerbox's angular_average: cells at (or beyond) the maximum |k| are excluded.
+            kmag = np.sqrt(np.add.outer(np.add.outer(coords[1] ** 2, coords[0] ** 2), coords[2] ** 2))
+            edges = np.linspace(kmag.min(), kmag.max(), bins + 1)
+            indx = np.digitize(kmag, edges)
+            sumweights = np.bincount(indx.ravel(), weights=w.ravel(), minlength=bins + 2)
+
+            # The bin co-ordinates are the weighted average |k| of the cells within them.
+            k = np.bincount(indx.ravel(), weights=(w * kmag).ravel(), minlength=bins + 2)[1:-1] / sumweights[1:-1]
+        else:
+            radial_bins = np.linspace(0, np.sqrt(2 * np.max(coords[0]) ** 2), bins + 1)
+            kperp_indx = np.digitize(np.add.outer(coords[1] ** 2, coords[0] ** 2), bins=radial_bins ** 2) - 1
+            kperp_indx = np.clip(kperp_indx, 0, bins)
+
+            # Each kpar gets its own set of kperp bins in the flat output.
+            indx = kperp_indx[:, :, None] + (bins + 1) * np.arange(len(coords[2]))
+            sumweights = np.bincount(indx.ravel(), weights=w.ravel(), minlength=(bins + 1) * len(coords[2]))
+            k = (radial_bins[1:] + radial_bins[:-1]) / 2
+
+        return indx, sumweights, k
 
     # def suppressedFg_1DPower(self, bins = 20):
     #
@@ -207,18 +551,38 @@ class LikelihoodForeground2D(LikelihoodBase):
     #
     #     return P_1D, uncertainty_1D
 
+    def grid_visibilities(self, visibilities, baselines, frequencies, ngrid, umax=None, baseline_weights=None):
+        """
+        Grid a set of visibilities from baselines onto a UV grid, as :meth:`grid`.
+
+        The assignment of each baseline to a grid cell at each frequency (see :meth:`grid_indices`) is cached on the
+        instance, so that it is only re-computed if `baselines`, `frequencies`, `ngrid`, `umax` or
+        `baseline_weights` change.
+        """
+        return self.grid(
+            visibilities, baselines, frequencies, ngrid, umax, baseline_weights=baseline_weights,
+            indices=self.stages["grid_indices"](
+                baselines=baselines, frequencies=frequencies, ngrid=ngrid, umax=umax,
+                baseline_weights=baseline_weights
+            )
+        )
+
     @staticmethod
-    def grid(visibilities, baselines, frequencies, ngrid, umax=None):
+    def grid(visibilities, baselines, frequencies, ngrid, umax=None, baseline_weights=None, indices=None):
         """
         Grid a set of visibilities from baselines onto a UV grid.
 
         Uses simple nearest-neighbour weighting to perform the gridding. This is fast, but not necessarily very
         accurate.
 
+        All frequencies (and all sets of visibilities in a stack) are gridded at once, from the grid cell of each
+        baseline at each frequency (see :meth:`grid_indices`).
+
         Parameters
         ----------
-        visibilities : complex (n_baselines, n_freq)-array
-            The visibilities at each basline and frequency.
+        visibilities : complex (..., n_baselines, n_freq)-array
+            The visibilities at each basline and frequency. Any leading axes (eg. walkers) are gridded
+            independently.
 
         baselines : (n_baselines, 2)-array
             The physical baselines of the array, in metres.
@@ -233,90 +597,174 @@ class LikelihoodForeground2D(LikelihoodBase):
         umax : float, optional
             The extent of the UV grid. By default, uses the longest baseline at the highest frequency.
 
+        baseline_weights : (n_baselines,)-array, optional
+            The weight of each baseline, eg. the multiplicity of a group of redundant baselines (see
+            :meth:`~core.CoreInstrumental.group_redundant_baselines`). By default, each baseline has unit weight.
+
+        indices : tuple, optional
+            The output of :meth:`grid_indices` for these baselines, frequencies, `ngrid`, `umax` and weights, if it
+            has already been computed (eg. by :meth:`grid_visibilities`).
+
         Returns
         -------
         centres : (ngrid,)-array
             The co-ordinates of the grid cells, in UV.
 
-        visgrid : (ngrid, ngrid, n_freq)-array
+        visgrid : (..., ngrid, ngrid, n_freq)-array
             The visibility grid, in Jy.
 
         weights : (ngrid, ngrid, n_freq)-array
-            The weights of the visibility grid (i.e. how many baselines contributed to each).
+            The weights of the visibility grid (i.e. how many baselines contributed to each). This array may be
+            shared between calls, and is read-only.
+        """
+        if indices is None:
+            indices = LikelihoodForeground2D.grid_indices(baselines, frequencies, ngrid, umax, baseline_weights)
+        centres, indx, weights = indices
+
+        # Grid real and imaginary parts in a single pass, by interleaving them.
+        visibilities = np.ascontiguousarray(visibilities, dtype=np.complex128)
+        if baseline_weights is not None:
+            visibilities = visibilities * np.asarray(baseline_weights)[:, None]
+
+        # Each set of visibilities in a stack is gridded into its own grid, with its own overflow element.
+        batch = visibilities.shape[:-2]
+        nbatch = int(np.prod(batch))
+        size = weights.size + 1
+
+        sums = np.bincount(
+            (2 * (indx + size * np.arange(nbatch)[:, None, None])[..., None] + np.arange(2)).ravel(),
+            weights=visibilities.view(np.float64).ravel(),
+            minlength=2 * size * nbatch
+        )
+        visgrid = sums.view(np.complex128).reshape((nbatch, size))[:, :-1].reshape(batch + weights.shape)
+
+        # Cells outside the grid collect in the trailing overflow element, which has been dropped above.
+        mask = weights > 0
+        visgrid[..., mask] /= weights[mask]
+
+        return centres, visgrid, weights
+
+    @staticmethod
+    def grid_indices(baselines, frequencies, ngrid, umax=None, baseline_weights=None):
         """
+        Determine the UV grid cell into which each baseline falls, at each frequency.
+
+        Parameters
+        ----------
+        baselines : (n_baselines, 2)-array
+            The physical baselines of the array, in metres (either as a plain array or a Quantity).
+
+        frequencies : (n_freq)-array
+            The frequencies of the observation, in Hz.
+
+        ngrid : int
+            The number of grid cells to form in the grid, per side.
+
+        umax : float, optional
+            The extent of the UV grid. By default, uses the longest baseline at the highest frequency.
+
+        baseline_weights : (n_baselines,)-array, optional
+            The weight of each baseline. By default, each baseline has unit weight.
+
+        Returns
+        -------
+        centres : (ngrid,)-array
+            The co-ordinates of the grid cells, in UV.
+
+        indx : int (n_baselines, n_freq)-array
+            The flat index of each (baseline, frequency) into a C-ordered (ngrid, ngrid, n_freq) array. Baselines
+            falling outside the grid are given an index of ``ngrid**2 * n_freq``.
+
+        weights : (ngrid, ngrid, n_freq)-array
+            The (weighted) number of baselines falling into each grid cell.
+        """
+        baselines = _in_metres(baselines)
+        frequencies = np.asarray(frequencies)
+        nfreq = len(frequencies)
+
         if umax is None:
-            umax = max([np.abs(b).max() for b in baselines]) * frequencies.max()/const.c
+            umax = np.abs(baselines).max() * frequencies.max() / const.c.value
 
-        ugrid = np.linspace(-umax, umax, ngrid+1) # +1 because these are bin edges.
-        visgrid = np.zeros((ngrid, ngrid, len(frequencies)), dtype=np.complex128)
-        weights = np.zeros((ngrid, ngrid, len(frequencies)))
+        ugrid = np.linspace(-umax, umax, ngrid + 1)  # +1 because these are bin edges.
 
-        for j, f in enumerate(frequencies):
-            # U,V values change with frequency.
-            u = baselines[:, 0] * f / const.c
-            v = baselines[:, 1] * f / const.c
+        # U,V values change with frequency. They are computed in the same order of operations as umax, so that the
+        # longest baseline at the highest frequency falls exactly on the edge of the grid (and is kept).
+        u = np.outer(baselines[:, 0], frequencies) / const.c.value
+        v = np.outer(baselines[:, 1], frequencies) / const.c.value
 
-            # TODO: doing three of the same histograms is probably unnecessary.
-            weights[:, :, j] = np.histogram2d(u.value, v.value, bins=[ugrid, ugrid])[0]
-            rl = np.histogram2d(u.value, v.value, bins=[ugrid, ugrid], weights=np.real(visibilities[:,j]))[0]
-            im = np.histogram2d(u.value, v.value, bins=[ugrid, ugrid], weights=np.imag(visibilities[:,j]))[0]
+        # Same binning convention as np.histogram2d: bins are half-open, except the last which includes its edge.
+        iu = np.searchsorted(ugrid, u, side='right') - 1
+        iv = np.searchsorted(ugrid, v, side='right') - 1
+        iu[u == ugrid[-1]] = ngrid - 1
+        iv[v == ugrid[-1]] = ngrid - 1
 
-            visgrid[:, :, j] = (rl + im * 1j) / weights[:, :, j]
+        inside = (iu >= 0) & (iu < ngrid) & (iv >= 0) & (iv < ngrid)
+        indx = np.where(inside, (iu * ngrid + iv) * nfreq + np.arange(nfreq), ngrid ** 2 * nfreq)
 
-        visgrid[np.isnan(visgrid)] = 0.0
+        if baseline_weights is not None:
+            baseline_weights = np.broadcast_to(np.asarray(baseline_weights, dtype=float)[:, None], indx.shape).ravel()
 
-        centres = (ugrid[1:] + ugrid[:-1])/2
+        weights = np.bincount(indx.ravel(), weights=baseline_weights, minlength=ngrid ** 2 * nfreq + 1)[:-1]
+        weights = weights.reshape((ngrid, ngrid, nfreq)).astype(float)
+        weights.flags.writeable = False  # it is cached and shared between calls.
 
-        return centres, visgrid, weights
+        centres = (ugrid[1:] + ugrid[:-1]) / 2
+
+        return centres, indx, weights
 
     @staticmethod
-    def frequency_fft(vis, freq):
+    def frequency_fft(vis, freq, backend=None):
         """
         Fourier-transform a gridded visibility along the frequency axis.
 
         Parameters
         ----------
-        vis : complex (ncells, ncells, nfreq)-array
+        vis : complex (..., ncells, ncells, nfreq)-array
             The gridded visibilities.
 
         freq : (nfreq)-array
             The linearly-spaced frequencies of the observation.
 
+        backend : optional
+            The FFT backend to use (see :func:`~dft.get_backend`). Default is numpy.
+
         Returns
         -------
-        ft : (ncells, ncells, nfreq/2)-array
+        ft : (..., ncells, ncells, nfreq/2)-array
             The fourier-transformed signal, with negative eta removed.
 
         eta : (nfreq/2)-array
             The eta-coordinates, without negative values.
         """
-        ft, eta =fft(vis, (freq.max() - freq.min()), axes=(2,), a=0, b=2 * np.pi)
-        ft = ft[:,:, (int(len(freq)/2)+1):]
+        ft, eta = dft.fft(vis, (freq.max() - freq.min()), axes=(-1,), backend=backend)
+        ft = ft[..., (int(len(freq)/2)+1):]
         return ft, eta[0][(int(len(freq)/2)+1):]
 
     @staticmethod
     def hz_to_mpc(nu_min, nu_max):
         """
         Convert a frequency range in Hz to a distance range in Mpc.
-        """
-        z_max = 1420e6/nu_min - 1
-        z_min = 1420e6/nu_max - 1
 
-        return (cosmo.comoving_distance(z_max) - cosmo.comoving_distance(z_min)) / (nu_max - nu_min)
+        Returns a plain float (in Mpc/Hz), memoized for each band.
+        """
+        return conversions.hz_to_mpc(nu_min, nu_max)
 
     @staticmethod
     def sr_to_mpc2(z):
         """
         Conversion factor from steradian to Mpc^2 at a given redshift.
+
         Parameters
         ----------
-        z_mid
+        z : float
+            The redshift.
 
         Returns
         -------
-
+        factor : float
+            The conversion factor, memoized for each redshift.
         """
-        return cosmo.comoving_distance(z) / (1 * un.sr)
+        return conversions.sr_to_mpc2(z)
 
     @staticmethod
     def volume(z_mid, nu_min, nu_max, A_eff=20):
@@ -344,21 +792,18 @@ class LikelihoodForeground2D(LikelihoodBase):
         How is this actually calculated? What assumptions are made?
         """
         # TODO: fix the notes in the docs above.
+        return conversions.volume(z_mid, nu_min, nu_max, A_eff)
 
-        diff_nu = nu_max - nu_min
-
-        G_z = (cosmo.H0).to(un.m / (un.Mpc * un.s)) * 1420e6 * un.Hz * cosmo.efunc(z_mid) / (const.c * (1 + z_mid) ** 2)
-
-        Vol = const.c ** 2 / (A_eff * un.m ** 2 * nu_max * (1 / un.s) ** 2) * diff_nu * (
-                    1 / un.s) * cosmo.comoving_distance([z_mid]) ** 2 / (G_z)
-
-        return Vol.value
-
-    def simulate_data(self, fg_core, instr_core, params, niter=20):
+    def simulate_data(self, fg_core, instr_core, params, niter=20, nproc=1, seed=None, checkpoint=None):
         """
         Simulate datasets to which this very class instance should be compared, returning their mean and std.
         Writes the information to the datafile of this instance.
 
+        Each realisation is seeded with its own child of a :class:`numpy.random.SeedSequence`, from which the cores
+        draw via the "rng" of the context, so that the result depends only on `seed` (and not on `nproc`, or on
+        whether the run was resumed). Power spectra are accumulated
+        in a :class:`RunningStatistics`, so memory use does not grow with `niter`.
+
         Parameters
         ----------
         fg_core : :class:`~core.CoreForeground` instance
@@ -372,6 +817,18 @@ class LikelihoodForeground2D(LikelihoodBase):
         niter : int, optional
             Number of iterations to aggregate.
 
+        nproc : int, optional
+            The number of processes over which to spread the realisations. If greater than one, this instance and
+            the cores must be picklable.
+
+        seed : int, optional
+            The entropy of the seed sequence. By default, fresh entropy is used (and printed, so that the run can be
+            reproduced).
+
+        checkpoint : str, optional
+            A filename (without the ".npz") to which the accumulated statistics are saved after each realisation. If
+            it already exists, the run is resumed from it (with its seed), and only the remaining realisations are
+            simulated.
         """
         core = Core21cmFastModule(
             parameter_names=params.keys(),
@@ -380,73 +837,168 @@ class LikelihoodForeground2D(LikelihoodBase):
             astro_params=self._astro_params,
             cosmo_params=self._cosmo_params
         )
-
-        core.setup()
-        fg_core.setup()
-        instr_core.setup()
-
         params = Params(*[(k, v[1]) for k, v in params.items()])
-        ctx = ChainContext('derp', params)
-
-        p = [0] * niter
-        for i in range(niter):
-            # Here is where the __call__ happens!
-            core(ctx)
-            fg_core(ctx)
-            instr_core(ctx)
-
-            p[i], k = self.computePower(ctx)
-
-        sigma = np.std(np.array(p), axis=0)
-        p = np.mean(np.array(p), axis=0)
 
-        np.savez(self.datafile, k=k, p=p, sigma=sigma)
+        stats = RunningStatistics()
+        k = None
+        if checkpoint is not None and os.path.exists(checkpoint + ".npz"):
+            data = np.load(checkpoint + ".npz", allow_pickle=True)
+            stats = RunningStatistics(int(data["count"]), data["mean"], data["m2"])
+            seed = int(data["seed"])
+            k = data["k"]
+            print("Resuming from %s after %d realisations" % (checkpoint, stats.count))
+
+        seeds = np.random.SeedSequence(seed)
+        print("Simulating data with seed %d" % seeds.entropy)
+        children = seeds.spawn(niter)[stats.count:]
+
+        cores = (core, fg_core, instr_core)
+        if nproc > 1:
+            pool = Pool(nproc, initializer=_init_simulation, initargs=(self, cores, params))
+            results = pool.imap(_simulate_power, children)
+        else:
+            pool = None
+            _init_simulation(self, cores, params)
+            results = map(_simulate_power, children)
+
+        try:
+            for p, k in results:
+                # The 2D co-ordinates (kperp, kpar) have different lengths, so are saved as an object array.
+                if isinstance(k, list):
+                    k = np.array(k, dtype=object)
+
+                stats.update(p)
+                if checkpoint is not None:
+                    stats.save(checkpoint, seed=seeds.entropy, k=k)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            _init_simulation(None, None, None)
+
+        np.savez(self.datafile, k=k, p=stats.mean, sigma=stats.std)
 
 
 class LikelihoodForeground1D(LikelihoodForeground2D):
-    def computePower(self, ctx):
-        # Read in data from ctx
-        visibilities = ctx.get("visibilities")
-        baselines = ctx.get('baselines')
-        frequencies = ctx.get("frequencies")
-        n_uv = self.n_uv or ctx.get("output").lightcone_box.shape[0]
-
-        ugrid, visgrid, weights = self.grid(visibilities, baselines, frequencies, n_uv)
+    def power_spectrum(self, visibilities, baselines, frequencies, n_uv, baseline_weights=None):
+        ugrid, visgrid, weights = self.grid_visibilities(
+            visibilities, baselines, frequencies, n_uv, baseline_weights=baseline_weights
+        )
 
-        visgrid, eta = self.frequency_fft(visgrid, frequencies)
+        visgrid, eta = self.frequency_fft(visgrid, frequencies, dft.get_backend(self.fft_backend, self.fft_threads))
 
-        # TODO: this is probably wrong!
-        #weights = np.sum(weights, axis=-1)
         power2d, coords  = self.get_1D_power(visgrid, [ugrid, ugrid, eta], weights, frequencies, bins=self.n_psbins )
 
         # Find the 1D Power Spectrum of the visibility
         #self.get_1D_power(visgrid, [ugrid, ugrid, eta[0]], weights, frequencies, bins=self.n_psbins)
         return power2d, coords
 
+    def noise_bias(self, sigma, baselines, frequencies, n_uv, baseline_weights=None):
+        """
+        The expected 1D power spectrum of the thermal noise alone (see :meth:`LikelihoodForeground2D.noise_bias`).
+        """
+        ugrid, variance, eta, weights = self.noise_variance(
+            sigma, baselines, frequencies, n_uv, baseline_weights=baseline_weights
+        )
+        return self.get_1D_power(np.sqrt(variance), [ugrid, ugrid, eta], weights, frequencies, bins=self.n_psbins)
+
     def get_1D_power(self, visibility, coords, weights, linFrequencies, bins=100):
 
-        print("Finding the power spectrum")
         ## Change the units of coords to Mpc
         z_mid = (1420e6) / (np.mean(linFrequencies)) - 1
-        coords[0] = 2 * np.pi * coords[0] / cosmo.comoving_transverse_distance([z_mid])
-        coords[1] = 2 * np.pi * coords[1] / cosmo.comoving_transverse_distance([z_mid])
-        coords[2] = 2 * np.pi * coords[2] * (cosmo.H0).to(un.m / (un.Mpc * un.s)) * 1420e6 * un.Hz * cosmo.efunc(
-            z_mid) / (const.c * (1 + z_mid) ** 2)
+        kperp = 2 * np.pi * coords[0] / conversions.comoving_transverse_distance(z_mid)
+        kperp_y = 2 * np.pi * coords[1] / conversions.comoving_transverse_distance(z_mid)
+        kpar = coords[2] * conversions.eta_to_kpar(z_mid)
 
         # Change the unit of visibility
-        visibility = visibility / CoreForegrounds.conversion_factor_K_to_Jy() * self.hz_to_mpc(np.min(linFrequencies),
-                                                                                               np.max(
-                                                                                                   linFrequencies)) * self.sr_to_mpc2(
-            z_mid)
+        visibility = visibility * (
+                self.hz_to_mpc(np.min(linFrequencies), np.max(linFrequencies)) * self.sr_to_mpc2(z_mid) /
+                conversions.K_to_Jy()
+        )
 
         # Square the visibility
         visibility_sq = np.abs(visibility) ** 2
 
-        # TODO: check if this is correct (reshaping might be in wrong order)
-        weights = np.repeat(weights, len(coords[2])).reshape((len(coords[0]), len(coords[1]), len(coords[2])))
-
-        PS_mK2Mpc6, k_Mpc = angular_average_nd(visibility_sq, coords, bins=bins, weights=weights)
+        # Spherically average, using the same weights as the 2D power spectrum.
+        PS_mK2Mpc6, k_Mpc = self.bin_power(visibility_sq, [kperp, kperp_y, kpar], weights, bins, spherical=True)
 
         PS_mK2Mpc3 = PS_mK2Mpc6 / self.volume(z_mid, np.min(linFrequencies), np.max(linFrequencies))
 
         return PS_mK2Mpc3, k_Mpc
+
+
+class RunningStatistics:
+    """
+    A streaming (Welford) accumulator of the mean and variance of a sequence of arrays.
+
+    Parameters
+    ----------
+    count : int, optional
+        The number of arrays already accumulated.
+
+    mean, m2 : array, optional
+        The mean, and the sum of squared deviations from it, of the arrays already accumulated.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, x):
+        """
+        Add an array to the accumulated statistics.
+        """
+        self.count += 1
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        """The (population) variance of the accumulated arrays."""
+        return self.m2 / self.count
+
+    @property
+    def std(self):
+        """The (population) standard deviation of the accumulated arrays, as from ``np.std``."""
+        return np.sqrt(self.variance)
+
+    def save(self, fname, **kwargs):
+        """
+        Save the accumulated statistics (and any other arrays in `kwargs`) to `fname` + ".npz".
+
+        The file is replaced atomically, so that an interrupted save leaves the previous one intact.
+        """
+        np.savez(fname + ".tmp.npz", count=self.count, mean=self.mean, m2=self.m2, **kwargs)
+        os.replace(fname + ".tmp.npz", fname + ".npz")
+
+
+# The likelihood, cores and parameters used by _simulate_power in each worker of simulate_data.
+_simulation = None
+
+
+def _init_simulation(likelihood, cores, params):
+    global _simulation
+
+    if cores is not None:
+        for core in cores:
+            core.setup()
+
+    _simulation = (likelihood, cores, params)
+
+
+def _simulate_power(seed):
+    """
+    Run one realisation of the cores set by :func:`_init_simulation`, from a SeedSequence `seed`, returning its power.
+    """
+    likelihood, cores, params = _simulation
+
+    # The cores draw from the Generator in the context, and anything else from numpy's global state.
+    np.random.seed(seed.generate_state(4))
+    ctx = ChainContext('derp', params)
+    ctx.add("rng", np.random.default_rng(seed.spawn(1)[0]))
+    for core in cores:
+        # Here is where the __call__ happens!
+        core(ctx)
+
+    return likelihood.computePower(ctx)
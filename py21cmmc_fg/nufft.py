@@ -0,0 +1,142 @@
+"""
+A type-2 non-uniform FFT in numpy, for evaluating the Fourier transform of a gridded sky at arbitrary (u, v).
+
+The transform of an (N1, N2) grid is evaluated at non-uniform points by the standard three steps: the grid is divided
+by the Fourier transform of a compact gridding kernel and zero-padded onto an oversampled grid, which is FFT'd, and
+the result is interpolated onto each point with the kernel. The kernel is the "exponential of semicircle" of
+Barnett et al. (2019, FINUFFT), whose width (and hence cost) is set by the requested accuracy.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from . import dft
+
+
+@lru_cache(maxsize=None)
+def kernel_params(eps=1e-6, upsampfac=2.0):
+    """
+    The width (in oversampled grid cells) and shape parameter of the gridding kernel for a given accuracy.
+
+    Parameters
+    ----------
+    eps : float, optional
+        The requested relative accuracy.
+
+    upsampfac : float, optional
+        The oversampling factor of the FFT grid.
+
+    Returns
+    -------
+    width : int
+        The number of fine grid cells the kernel spans in each dimension.
+
+    beta : float
+        The shape parameter of the kernel.
+    """
+    width = int(np.ceil(np.log(1 / eps) / (np.pi * np.sqrt(1 - 1 / upsampfac)))) + 1
+    width = min(max(width, 2), 16)
+    beta = 0.97 * np.pi * (1 - 1 / (2 * upsampfac)) * width
+
+    return width, beta
+
+
+def kernel(z, beta):
+    """
+    The "exponential of semicircle" kernel, ``exp(beta * (sqrt(1 - z**2) - 1))``, on its support ``|z| <= 1``.
+    """
+    z = np.asarray(z)
+    return np.exp(beta * (np.sqrt(np.clip(1 - z ** 2, 0, None)) - 1)) * (np.abs(z) <= 1)
+
+
+def kernel_ft(xi, width, beta):
+    """
+    The continuous Fourier transform of the kernel (spanning `width` cells), at frequencies `xi` (in radians per
+    cell). Evaluated by Gauss-Legendre quadrature.
+    """
+    z, w = np.polynomial.legendre.leggauss(4 * width + 20)
+    return (width / 2) * np.cos(np.outer(xi, z) * width / 2) @ (w * kernel(z, beta))
+
+
+def _spread_weights(t, M, width, beta):
+    """
+    The fine-grid indices (modulo M) and kernel weights of each point `t` (in radians per coarse cell).
+    """
+    # Position in units of fine grid cells
+    x = t * M / (2 * np.pi)
+
+    first = np.ceil(x - width / 2).astype(int)
+    l = first[..., None] + np.arange(width)
+
+    return l % M, kernel(2 * (x[..., None] - l) / width, beta)
+
+
+def nufft2d2(f, x, y, eps=1e-6, upsampfac=2.0, backend=None):
+    """
+    Evaluate the 2D discrete-time Fourier transform of a (stack of) grid(s) at non-uniform points.
+
+    Computes ``F[p, i] = sum_{j,k} f[j, k, i] * exp(-1j * (x[p, i] * j + y[p, i] * k))``.
+
+    Parameters
+    ----------
+    f : (N1, N2, nf, ...)-array
+        The grids. The third axis is a stack of independent grids (eg. frequencies), and any further axes are
+        grids evaluated at the same points as their frequency (eg. walkers).
+
+    x, y : (npts, nf)-arrays
+        The points at which to evaluate the transform of each grid, in radians per cell (the transform is
+        2pi-periodic).
+
+    eps : float, optional
+        The requested relative accuracy. Smaller values use a wider kernel, and are slower.
+
+    upsampfac : float, optional
+        The oversampling factor of the FFT grid.
+
+    backend : optional
+        The FFT backend (see :func:`~dft.get_backend`). Default is numpy.
+
+    Returns
+    -------
+    F : complex (npts, nf, ...)-array
+        The transform at each point.
+    """
+    backend = backend or dft.get_backend()
+    width, beta = kernel_params(eps, upsampfac)
+
+    N1, N2, nf = f.shape[:3]
+    extra = f.shape[3:]
+    nextra = int(np.prod(extra))
+    M1, M2 = [max(int(np.ceil(upsampfac * n)), 2 * width) for n in (N1, N2)]
+
+    # The modes are centred, j -> j - N//2, so that the kernel correction is accurate for all of them.
+    j1 = np.arange(N1) - N1 // 2
+    j2 = np.arange(N2) - N2 // 2
+
+    # Divide by the kernel's transform. Each grid in the stack is made contiguous, for faster FFTs.
+    correction = np.outer(
+        1 / kernel_ft(2 * np.pi * j1 / M1, width, beta), 1 / kernel_ft(2 * np.pi * j2 / M2, width, beta)
+    )
+    f = np.moveaxis(np.reshape(f, (N1, N2, nf * nextra)), -1, 0) * correction
+
+    # Zero-pad onto the oversampled grid and FFT it. Only N1 of the M1 rows are non-zero, so the first (row-wise)
+    # transform is done on those alone.
+    rows = np.zeros((nf * nextra, N1, M2), dtype=np.complex128)
+    rows[:, :, j2 % M2] = f
+    rows = backend.fftn(rows, axes=(2,))
+
+    fine = np.zeros((nf * nextra, M1, M2), dtype=np.complex128)
+    fine[:, j1 % M1] = rows
+    fine = backend.fftn(fine, axes=(1,)).reshape(-1)
+
+    # Interpolate onto the points with the kernel, for all points and grids at once.
+    l1, w1 = _spread_weights(x, M1, width, beta)
+    l2, w2 = _spread_weights(y, M2, width, beta)
+
+    grids = np.arange(nf * nextra).reshape((nf, nextra))
+    indx = (grids[:, :, None, None] * M1 + l1[..., None, :, None]) * M2 + l2[..., None, None, :]
+    F = np.einsum("pia,pib,pijab->pij", w1, w2, fine[indx])
+
+    # Undo the centring of the modes.
+    F *= np.exp(-1j * (x * (N1 // 2) + y * (N2 // 2)))[..., None]
+    return F.reshape(F.shape[:2] + extra)
@@ -0,0 +1,253 @@
+"""
+Arrays in shared memory, which are passed between processes as lightweight handles rather than copied.
+
+When a chain is run with a process pool, anything in the context, and the cores and likelihoods themselves, are
+pickled into (or out of) the workers. A :class:`SharedArray` lives in a ``multiprocessing.shared_memory`` block or a
+memory-mapped file, and pickles as a handle to it (its name, shape and dtype), so that the receiving process maps
+the same memory instead of unpickling a copy.
+
+Shared arrays are created, and explicitly released, by a :class:`SharedMemoryPool`, which owns their memory::
+
+    with SharedMemoryPool() as pool:
+        likelihood.share(pool)
+        instrument.share(pool)
+        ...
+
+:class:`~core.CoreSharedMemory` moves the arrays of the context into a pool at each step.
+"""
+import os
+import tempfile
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# The shared memory blocks created by this process, and those it has attached, by name.
+_owned = {}
+_attached = weakref.WeakValueDictionary()
+
+
+class SharedArray(np.ndarray):
+    """
+    An array whose data is in shared memory, and which pickles as a handle to that memory.
+
+    Created by :meth:`SharedMemoryPool.share`, or from a handle with :func:`attach`. Views and the results of
+    operations on a shared array are ordinary arrays (the former in shared memory), which pickle as copies.
+    """
+
+    def __array_finalize__(self, obj):
+        self.handle = None
+
+    def __array_wrap__(self, obj, context=None, return_scalar=False):
+        # The results of ufuncs are not in shared memory.
+        obj = obj.view(np.ndarray)
+        return obj[()] if return_scalar else obj
+
+    def __reduce__(self):
+        if self.handle is None:
+            return self.view(np.ndarray).__reduce__()
+        return attach, (self.handle,)
+
+
+def attach(handle):
+    """
+    Map the shared array of a handle into this process.
+
+    Parameters
+    ----------
+    handle : tuple
+        The ``(kind, name, shape, dtype)`` of the array, where `kind` is "shm" (`name` is that of a shared memory
+        block) or "memmap" (`name` is a file name).
+
+    Returns
+    -------
+    array : :class:`SharedArray`
+        The array, which is backed by the shared memory (writes are seen by all processes).
+    """
+    kind, name, shape, dtype = handle
+
+    if kind == "shm":
+        memory = _owned.get(name) or _attached.get(name)
+        if memory is None:
+            try:
+                memory = _attached[name] = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                raise ValueError("the shared array '%s' has been released by its pool" % name)
+
+        array = np.ndarray(shape, dtype=dtype, buffer=memory.buf).view(SharedArray)
+
+        # The block is unmapped when the last array using it is garbage collected.
+        array._memory = memory
+    elif kind == "memmap":
+        if not os.path.exists(name):
+            raise ValueError("the shared array '%s' has been released by its pool" % name)
+        array = np.memmap(name, dtype=dtype, mode="r+", shape=shape).view(SharedArray)
+    else:
+        raise ValueError("unknown kind of shared array '%s'" % kind)
+
+    array.handle = handle
+    return array
+
+
+class SharedMemoryPool:
+    def __init__(self, backend="shm", directory=None):
+        """
+        Creates shared arrays, and owns their memory until they are released.
+
+        The memory of a pool is only released by :meth:`release` or :meth:`close` (or on leaving a ``with`` block),
+        in the process which created it. Arrays already mapped elsewhere stay valid until they are garbage
+        collected, but can no longer be attached. A pool pickles as an empty pool, so that copies of it (eg. in the
+        workers of a process pool) do not release the memory of the original.
+
+        Parameters
+        ----------
+        backend : {"shm", "memmap"}, optional
+            Whether arrays are placed in ``multiprocessing.shared_memory`` blocks, or in memory-mapped files (which
+            may also be used to share arrays larger than memory, or between unrelated processes).
+
+        directory : str, optional
+            The directory of the files of the "memmap" backend. Default is the system's temporary directory.
+        """
+        if backend not in ("shm", "memmap"):
+            raise ValueError("backend must be 'shm' or 'memmap', got '%s'" % backend)
+
+        self.backend = backend
+        self.directory = directory
+
+        # The arrays owned by the pool, by key.
+        self._arrays = {}
+
+        # The keys of the arrays shared by each of the latest calls of share_context, oldest first.
+        self._generations = []
+
+    def share(self, array, key=None):
+        """
+        Copy an array into shared memory.
+
+        Parameters
+        ----------
+        array : array_like
+            The array. Any astropy units are dropped.
+
+        key : str, optional
+            A name for the array in the pool. If the pool already has an array of the same shape and dtype under
+            this key, it is overwritten in place, rather than allocating new memory. This makes it cheap to share a
+            new array of the same kind at every step, but the previous one must no longer be in use.
+
+        Returns
+        -------
+        array : :class:`SharedArray`
+            The shared copy of the array.
+        """
+        array = np.asarray(array)
+
+        shared = self._arrays.get(key) if key is not None else None
+        if shared is None or shared.shape != array.shape or shared.dtype != array.dtype:
+            if key is not None and key in self._arrays:
+                self.release(key)
+
+            shared = self._allocate(array.shape, array.dtype)
+            self._arrays[shared.handle[1] if key is None else key] = shared
+
+        shared[...] = array
+        return shared
+
+    def _allocate(self, shape, dtype):
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+
+        if self.backend == "shm":
+            memory = shared_memory.SharedMemory(create=True, size=nbytes)
+            _owned[memory.name] = memory
+            name = memory.name
+        else:
+            fd, name = tempfile.mkstemp(suffix=".dat", prefix="py21cmmc_fg_", dir=self.directory)
+            os.ftruncate(fd, nbytes)
+            os.close(fd)
+
+        return attach((self.backend, name, tuple(shape), dtype.str))
+
+    def release(self, key):
+        """
+        Release the memory of one of the pool's arrays.
+        """
+        kind, name = self._arrays.pop(key).handle[:2]
+
+        if kind == "shm":
+            # The mapping itself is closed once no array uses it.
+            _owned.pop(name).unlink()
+        else:
+            os.remove(name)
+
+    def close(self):
+        """
+        Release the memory of all of the pool's arrays.
+        """
+        for key in list(self._arrays):
+            self.release(key)
+        self._generations = []
+
+    @property
+    def nbytes(self):
+        """The total size of the pool's arrays, in bytes."""
+        return sum(array.nbytes for array in self._arrays.values())
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __reduce__(self):
+        return SharedMemoryPool, (self.backend, self.directory)
+
+    def share_context(self, ctx, keys=("visibilities", "baselines", "baseline_weights", "frequencies"),
+                      lightcone=True, keep=2):
+        """
+        Replace the arrays of a context by shared copies, so that the context pickles as handles.
+
+        Each call (ie. each step) shares its arrays in newly allocated memory, so that the handles of a step never
+        see the data of a later one. The memory of a step is released once `keep` newer steps have been shared, after
+        which its handles can no longer be attached (but arrays already mapped stay valid). Arrays which are already
+        shared (eg. those of a core which has been shared with :meth:`share`) are left as they are.
+
+        Parameters
+        ----------
+        ctx : :class:`~cosmoHammer.ChainContext`
+            The context.
+
+        keys : tuple of str, optional
+            The keys of the arrays to share. Missing or None values are skipped.
+
+        lightcone : bool, optional
+            Whether to also share the ``lightcone_box`` of the "output" :class:`~py21cmmc.LightCone`.
+
+        keep : int, optional
+            The number of steps whose memory is kept, including this one. It must cover every step whose context
+            may still be in flight (eg. being pickled to, or not yet attached by, another process).
+        """
+        generation = []
+
+        for key in keys:
+            value = ctx.get(key, None)
+            if value is not None and not _is_shared(value):
+                value = self.share(value)
+                generation.append(value.handle[1])
+                ctx.add(key, value)
+
+        output = ctx.get("output", None)
+        if lightcone and output is not None and not _is_shared(output.lightcone_box):
+            output.lightcone_box = self.share(output.lightcone_box)
+            generation.append(output.lightcone_box.handle[1])
+
+        self._generations.append(generation)
+        while len(self._generations) > max(keep, 1):
+            for key in self._generations.pop(0):
+                if key in self._arrays:
+                    self.release(key)
+
+
+def _is_shared(array):
+    return isinstance(array, SharedArray) and array.handle is not None
@@ -0,0 +1,308 @@
+"""
+Compact representations of foreground skies.
+
+Foreground lightcones are mostly *separable*: a 2D map on the sky multiplied by a spectrum in frequency. Rather
+than expanding them into full (ncells, ncells, nfreq) cubes, the classes here store only the maps and spectra, and
+form slabs of the cube on demand. They can be indexed like a lightcone array (``sky[:, :, slab]``), so that they may
+be streamed through :class:`~core.CoreInstrumental`, or added in-place to an existing lightcone with :meth:`add_to`.
+"""
+import numpy as np
+
+
+class Sky:
+    """
+    Base class for skies of shape (ncells, ncells, nfreq) which are only expanded a slab of frequencies at a time.
+
+    Subclasses must define :attr:`shape` and :meth:`slab`.
+    """
+    #: Default number of frequencies to expand at a time in :meth:`add_to`.
+    slab_size = 16
+
+    ndim = 3
+    dtype = np.dtype(np.float64)
+
+    @property
+    def nfreq(self):
+        return self.shape[2]
+
+    def slab(self, freq_index=slice(None)):
+        """
+        Expand the sky at a subset of its frequencies.
+
+        Parameters
+        ----------
+        freq_index : slice, int or array, optional
+            Index into the frequencies.
+
+        Returns
+        -------
+        sky : (ncells, ncells, ...)-array
+            The sky at the chosen frequencies (2D if `freq_index` is an integer).
+        """
+        raise NotImplementedError
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        ellipsis = [j for j, i in enumerate(item) if i is Ellipsis]
+        if len(ellipsis) > 1 or len(item) - len(ellipsis) > 3:
+            raise IndexError("Only (up to) three explicit indices, and one ellipsis, are supported.")
+
+        if ellipsis:
+            j = ellipsis[0]
+            item = item[:j] + (slice(None),) * (4 - len(item)) + item[j + 1:]
+
+        item = item + (slice(None),) * (3 - len(item))
+        return self.slab(item[2])[item[0], item[1]]
+
+    def __array__(self, dtype=None, copy=None):
+        sky = self.slab()
+        return sky if dtype is None else sky.astype(dtype)
+
+    def __add__(self, other):
+        if not isinstance(other, Sky):
+            return NotImplemented
+        if other.shape != self.shape:
+            raise ValueError("Cannot add skies of shapes %s and %s" % (self.shape, other.shape))
+
+        return CompositeSky([self, other])
+
+    def add_to(self, lightcone, scale=1, slab_size=None):
+        """
+        Add this sky to a lightcone in-place, a slab of frequencies at a time.
+
+        Parameters
+        ----------
+        lightcone : (ncells, ncells, nfreq)-array
+            The lightcone to add to.
+
+        scale : float, optional
+            A factor by which to multiply this sky before adding.
+
+        slab_size : int, optional
+            The number of frequencies to expand at once. Memory use is bounded by this, rather than the full
+            lightcone size.
+
+        Returns
+        -------
+        lightcone : array
+            The same (modified) array.
+        """
+        if lightcone.shape != self.shape:
+            raise ValueError("Cannot add sky of shape %s to lightcone of shape %s" % (self.shape, lightcone.shape))
+
+        slab_size = slab_size or self.slab_size
+        for start in range(0, self.nfreq, slab_size):
+            slab = slice(start, start + slab_size)
+            lightcone[:, :, slab] += scale * self.slab(slab)
+
+        return lightcone
+
+
+class SeparableSky(Sky):
+    """
+    A sky which is a sum of separable terms, ``maps[i] * spectra[i]``.
+
+    Parameters
+    ----------
+    maps : (ncells, ncells)- or (nterms, ncells, ncells)-array
+        The angular map of each term.
+
+    spectra : (nfreq,)- or (nterms, nfreq)-array
+        The spectrum of each term.
+    """
+
+    def __init__(self, maps, spectra):
+        maps = np.asarray(maps, dtype=float)
+        spectra = np.asarray(spectra, dtype=float)
+
+        self.maps = maps[None] if maps.ndim == 2 else maps
+        self.spectra = spectra[None] if spectra.ndim == 1 else spectra
+
+        if len(self.maps) != len(self.spectra):
+            raise ValueError("maps and spectra must have the same number of terms.")
+
+    @property
+    def shape(self):
+        return self.maps.shape[1:] + self.spectra.shape[1:]
+
+    def slab(self, freq_index=slice(None)):
+        return np.tensordot(self.maps, self.spectra[:, freq_index], axes=(0, 0))
+
+    def __mul__(self, factor):
+        return SeparableSky(self.maps, self.spectra * factor)
+
+    __rmul__ = __mul__
+
+
+class PointSourceSky(Sky):
+    """
+    A sky of point sources, each with its own power-law spectrum ``flux * (nu/nu0)**(-spectral_index)``.
+
+    If all sources share a spectral index this is separable, and :func:`point_source_sky` returns a plain
+    :class:`SeparableSky` instead. Otherwise, each slab is formed by depositing every source at each frequency.
+
+    Parameters
+    ----------
+    cells : int (nsources,)-array
+        The flat (C-ordered) index of the sky cell holding each source.
+
+    fluxes : (nsources,)-array
+        The brightness of each source at `nu0` (in units of the sky, eg. Jy/sr).
+
+    spectral_index : (nsources,)-array
+        The spectral index of each source.
+
+    frequencies : (nfreq,)-array
+        The frequencies of the sky.
+
+    ncells : int
+        The number of cells per side of the sky.
+
+    nu0 : float
+        The reference frequency of the fluxes.
+    """
+
+    def __init__(self, cells, fluxes, spectral_index, frequencies, ncells, nu0):
+        self.cells = np.asarray(cells)
+        self.fluxes = np.asarray(fluxes, dtype=float)
+        self.spectral_index = np.asarray(spectral_index, dtype=float)
+        self.frequencies = np.asarray(frequencies, dtype=float)
+        self.ncells = ncells
+        self.nu0 = nu0
+        self.scale = 1
+
+    @property
+    def shape(self):
+        return (self.ncells, self.ncells, len(self.frequencies))
+
+    def slab(self, freq_index=slice(None)):
+        freqs = np.atleast_1d(self.frequencies[freq_index])
+        nslab = len(freqs)
+
+        weights = self.scale * self.fluxes[:, None] * (freqs / self.nu0) ** (-self.spectral_index[:, None])
+        sky = np.bincount(
+            (self.cells[:, None] * nslab + np.arange(nslab)).ravel(), weights=weights.ravel(),
+            minlength=self.ncells ** 2 * nslab
+        ).reshape(self.shape[:2] + (nslab,))
+
+        return sky[:, :, 0] if np.ndim(self.frequencies[freq_index]) == 0 else sky
+
+    def __mul__(self, factor):
+        new = PointSourceSky(self.cells, self.fluxes, self.spectral_index, self.frequencies, self.ncells, self.nu0)
+        new.scale = self.scale * factor
+        return new
+
+    __rmul__ = __mul__
+
+
+class CompositeSky(Sky):
+    """
+    A sum of skies of the same shape, each of which is only expanded a slab at a time.
+
+    Parameters
+    ----------
+    components : list of :class:`Sky`
+        The skies to sum.
+    """
+
+    def __init__(self, components):
+        self.components = []
+        for c in components:
+            self.components += c.components if isinstance(c, CompositeSky) else [c]
+
+    @property
+    def shape(self):
+        return self.components[0].shape
+
+    def slab(self, freq_index=slice(None)):
+        return sum(c.slab(freq_index) for c in self.components)
+
+    def __mul__(self, factor):
+        return CompositeSky([c * factor for c in self.components])
+
+    __rmul__ = __mul__
+
+
+class ArraySky(Sky):
+    """
+    A sky held as a full (ncells, ncells, nfreq) array, eg. a memory-mapped one, of which only the slabs in use are
+    read.
+
+    Parameters
+    ----------
+    cube : (ncells, ncells, nfreq)-array
+        The sky.
+    """
+
+    def __init__(self, cube):
+        self.cube = cube
+
+    @property
+    def shape(self):
+        return self.cube.shape
+
+    def slab(self, freq_index=slice(None)):
+        return np.asarray(self.cube[:, :, freq_index], dtype=float)
+
+    def __mul__(self, factor):
+        return ArraySky(np.asarray(self.cube) * factor)
+
+    __rmul__ = __mul__
+
+
+def point_source_sky(cells, fluxes, frequencies, ncells, spectral_index=0.0, nu0=150e6, background=None,
+                     background_index=None):
+    """
+    Deposit point sources onto a sky grid.
+
+    Parameters
+    ----------
+    cells : int (nsources,)-array
+        The flat (C-ordered) index of the sky cell holding each source.
+
+    fluxes : (nsources,)-array
+        The brightness of each source at `nu0`.
+
+    frequencies : (nfreq,)-array
+        The frequencies of the sky.
+
+    ncells : int
+        The number of cells per side of the sky.
+
+    spectral_index : float or (nsources,)-array, optional
+        The spectral index of all sources, or of each source, such that brightness scales as
+        ``(nu/nu0)**(-spectral_index)``.
+
+    nu0 : float, optional
+        The reference frequency of the fluxes.
+
+    background : (ncells, ncells)-array, optional
+        An additional map of (eg. unresolved) brightness at `nu0`, to be added to that of the sources.
+
+    background_index : float, optional
+        The spectral index of `background`. By default, the mean of `spectral_index`.
+
+    Returns
+    -------
+    sky : :class:`Sky`
+        If the spectral index is global (and shared by the background), a single separable term: the deposited map
+        (formed with a single ``np.bincount``) times the common spectrum. Otherwise, a :class:`PointSourceSky` (plus
+        a separable background, if given).
+    """
+    if background_index is None:
+        background_index = np.mean(spectral_index) if np.size(spectral_index) else 0.0
+
+    if np.ndim(spectral_index) == 0 and background_index == spectral_index:
+        sky = np.bincount(cells, weights=fluxes, minlength=ncells ** 2).reshape((ncells, ncells))
+        if background is not None:
+            sky = sky + background
+        return SeparableSky(sky, (np.asarray(frequencies) / nu0) ** (-spectral_index))
+
+    if np.ndim(spectral_index) == 0:
+        spectral_index = np.full(len(fluxes), spectral_index, dtype=float)
+
+    sky = PointSourceSky(cells, fluxes, spectral_index, frequencies, ncells, nu0)
+    if background is not None:
+        sky += SeparableSky(background, (np.asarray(frequencies) / nu0) ** (-background_index))
+    return sky
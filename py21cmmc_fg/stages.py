@@ -0,0 +1,230 @@
+"""
+Cached stages of the pipeline from the EoR lightcone to the likelihood.
+
+Most of the work downstream of the lightcone (the beam, the UV sampling and frequency interpolation operators, the
+assignment of baselines to UV cells and of cells to power spectrum bins, frozen foregrounds...) depends only on the
+lightcone geometry and the instrument, which are fixed for a whole chain. Each such step is a :class:`Stage`, which
+declares the inputs its output depends on, and is only recomputed when one of them changes. The stages of a core or
+likelihood are kept in a :class:`StageGraph` (its ``stages`` attribute), which counts the cache hits and misses of
+each, so that :func:`report` shows what work the steps of a chain actually do::
+
+    print(stages.report(foreground_core, instrument_core, likelihood))
+
+The output of a stage is often the input of another (eg. the beam cube of the instrument), in which case it is
+passed on as the same object at each hit, and the downstream stage hits too.
+"""
+import threading
+
+import numpy as np
+
+
+def _writable(value):
+    if isinstance(value, (list, tuple)):
+        return any(map(_writable, value))
+    return isinstance(value, np.ndarray) and value.flags.writeable
+
+
+def _snapshot(value):
+    # Writable arrays are copied, so that a later (in-place) change of their values is seen.
+    if isinstance(value, (list, tuple)):
+        return tuple(_snapshot(v) for v in value)
+    if isinstance(value, np.ndarray) and value.flags.writeable:
+        return np.array(value, subok=True)
+    return value
+
+
+def _freeze(output):
+    # Outputs are shared between calls, so their arrays are made read-only.
+    if isinstance(output, tuple):
+        for o in output:
+            _freeze(o)
+    elif isinstance(output, np.ndarray):
+        output.flags.writeable = False
+
+
+def _equal(a, b):
+    if a is b:
+        return True
+    if isinstance(a, (list, tuple)) or isinstance(b, (list, tuple)):
+        return (
+            isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)) and len(a) == len(b) and
+            all(map(_equal, a, b))
+        )
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.shape(a) == np.shape(b) and bool(np.array_equal(a, b))
+    try:
+        return bool(a == b)
+    except (TypeError, ValueError):
+        return False
+
+
+class Stage:
+    def __init__(self, name, compute, inputs, maxsize=1):
+        """
+        A step of the pipeline whose output is cached, and only recomputed when one of its declared inputs changes.
+
+        Inputs are passed (by keyword) to :meth:`__call__`. Writable arrays are compared by value with a copy taken
+        when the output was computed, so that changing them in place invalidates it. Other inputs which are the very
+        object they were then (eg. read-only, shared arrays) are assumed to be unchanged; otherwise, they too are
+        compared by value. Arrays in the output (or in a tuple of outputs) are made read-only, as they are shared
+        between calls.
+
+        A stage may be called from several threads at once: its cache is only looked up and updated under a lock,
+        while outputs are computed outside of it.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage, in reports.
+
+        compute : callable
+            The function computing the output, called with the inputs as keyword arguments.
+
+        inputs : tuple of str
+            The names of the inputs the output depends on.
+
+        maxsize : int, optional
+            The number of outputs (for different inputs) to keep, eg. one per slab of frequencies. The least
+            recently used is dropped first. If None, all outputs are kept.
+        """
+        self.name = name
+        self.compute = compute
+        self.inputs = tuple(inputs)
+        self.maxsize = maxsize
+
+        # The cached (inputs, snapshot of inputs, output), least recently used first.
+        self._entries = []
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __call__(self, **inputs):
+        if set(inputs) != set(self.inputs):
+            raise TypeError("stage '%s' takes the inputs %s, got %s" % (self.name, self.inputs, tuple(inputs)))
+
+        values = [inputs[name] for name in self.inputs]
+
+        with self._lock:
+            for i, (refs, snapshots, output) in enumerate(self._entries):
+                if all(
+                    (v is r and not _writable(v)) or _equal(v, s) for v, r, s in zip(values, refs, snapshots)
+                ):
+                    self.hits += 1
+                    self._entries.append(self._entries.pop(i))
+                    return output
+
+            self.misses += 1
+
+        output = self.compute(**inputs)
+        _freeze(output)
+
+        if self.maxsize is None or self.maxsize > 0:
+            with self._lock:
+                # Unchanged inputs which are already cached (eg. the baselines, for each slab) share their snapshot.
+                snapshots = []
+                for j, v in enumerate(values):
+                    shared = [s[j] for r, s, _ in self._entries if r[j] is v and _equal(v, s[j])]
+                    snapshots.append(shared[0] if shared else _snapshot(v))
+
+                self._entries.append((values, snapshots, output))
+                if self.maxsize is not None and len(self._entries) > self.maxsize:
+                    del self._entries[0]
+
+        return output
+
+    def clear(self):
+        """
+        Drop the cached outputs.
+        """
+        with self._lock:
+            self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class StageGraph:
+    """
+    The cached stages of a core or likelihood, by name.
+    """
+
+    def __init__(self):
+        self._stages = {}
+
+    def add(self, name, compute, inputs, maxsize=1):
+        """
+        Add a :class:`Stage` (see its arguments), and return it.
+        """
+        self._stages[name] = Stage(name, compute, inputs, maxsize)
+        return self._stages[name]
+
+    def __getitem__(self, name):
+        return self._stages[name]
+
+    def __iter__(self):
+        return iter(self._stages.values())
+
+    def __len__(self):
+        return len(self._stages)
+
+    def clear(self):
+        """
+        Drop the cached outputs of all stages.
+        """
+        for stage in self:
+            stage.clear()
+
+    def reset_counts(self):
+        """
+        Zero the hit and miss counts of all stages, eg. to count those of a single step.
+        """
+        for stage in self:
+            stage.hits = stage.misses = 0
+
+    def counts(self):
+        """
+        The ``(hits, misses)`` of each stage, by name.
+        """
+        return {stage.name: (stage.hits, stage.misses) for stage in self}
+
+
+def report(*sources):
+    """
+    A table of the cache hits and misses of each stage.
+
+    Parameters
+    ----------
+    sources :
+        Each a :class:`StageGraph`, an object with one (as ``stages``, eg. a core or likelihood), or a function
+        memoized with ``functools.lru_cache`` (eg. those of :mod:`~conversions`), which is reported as a single
+        stage.
+
+    Returns
+    -------
+    str :
+        One line per stage, with its owner, name, hits and misses.
+    """
+    lines = ["%-24s %-24s %8s %8s" % ("owner", "stage", "hits", "misses")]
+
+    for source in sources:
+        if hasattr(source, "cache_info"):
+            info = source.cache_info()
+            lines.append("%-24s %-24s %8d %8d" % (source.__module__, source.__name__, info.hits, info.misses))
+            continue
+
+        graph = getattr(source, "stages", source)
+        owner = "" if graph is source else type(source).__name__
+        for name, (hits, misses) in graph.counts().items():
+            lines.append("%-24s %-24s %8d %8d" % (owner, name, hits, misses))
+
+    return "\n".join(lines)
@@ -69,6 +69,7 @@ setup(
         'py21cmmc',
     ],
     extras_require={
+        'fftw': ['pyfftw'],
         # eg:
         #   'rst': ['docutils>=0.11'],
         #   ':python_version=="2.6"': ['argparse'],